@@ -0,0 +1,158 @@
+import codecs
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson 為選配：沒裝就退回標準 json
+    orjson = None
+
+
+# -----------------------------
+# JSON（data.json 等）
+# -----------------------------
+def read_json(path: str):
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_json(path: str, obj, pretty: bool = True) -> None:
+    """pretty=False 給中途存檔用（不縮排，寫得快）；最後一次再寫成縮排版"""
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0))
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2 if pretty else None)
+
+
+# -----------------------------
+# 逐筆進度（append-only JSONL）
+# -----------------------------
+def load_partial(path: str, src_mtime: int) -> dict:
+    """
+    讀回上次中斷前已完成的商品（url -> 更新後欄位），重跑時直接套用、不再抓
+    - 紀錄的 src_mtime 與目前 data.json 不同（data.json 已重新爬過 / 改過）就整份丟掉
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    stale = False
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except Exception:
+                continue  # 中斷時最後一行可能只寫了一半
+            if rec.get("src_mtime") != src_mtime:
+                stale = True
+                break
+            if rec.get("url"):
+                done[rec["url"]] = {k: v for k, v in rec.items() if k not in ("url", "src_mtime")}
+    if stale:
+        # 關檔後才刪：Windows 上開著的檔案不能刪
+        print(f"⚠️  {path} 不是這份 data.json 的進度，捨棄")
+        os.remove(path)
+        return {}
+    return done
+
+
+def append_partial(f, url: str, src_mtime: int, fields: dict) -> None:
+    """每完成一個商品就追加一行並落盤，取代每 5 筆重寫整份 data.json"""
+    rec = {"url": url, "src_mtime": src_mtime, **fields}
+    if orjson is not None:
+        f.write(orjson.dumps(rec).decode("utf-8") + "\n")
+    else:
+        f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+
+# -----------------------------
+# HTTP
+# -----------------------------
+def mount_retry_adapter(session: requests.Session, pool_maxsize: int = 64) -> requests.Session:
+    """keep-alive 連線池 + 指數退避重試（取代手寫 retry 迴圈，失敗時也不丟掉連線）"""
+    adapter = HTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.8,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["GET"],
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# 對站台的禮貌間隔（秒）：同一個 process 裡所有 thread 共用，兩次頁面請求的開始時間至少相隔這麼久
+CRAWL_DELAY = float(os.getenv("CRAWL_DELAY", "0.8"))
+_RATE_LOCK = threading.Lock()
+_next_request_at = 0.0
+
+
+def polite_wait(delay: float = CRAWL_DELAY) -> None:
+    """依 delay 排隊：並行抓取時整體請求速率仍不超過原本逐頁抓的節奏"""
+    global _next_request_at
+    if delay <= 0:
+        return
+    with _RATE_LOCK:
+        now = time.monotonic()
+        wait = _next_request_at - now
+        _next_request_at = max(now, _next_request_at) + delay
+    if wait > 0:
+        time.sleep(wait)
+
+
+_META_CHARSET_RE = re.compile(rb"""<meta[^>]+charset=["']?([\w-]+)""", re.IGNORECASE)
+
+
+def response_encoding(response) -> str:
+    """
+    取代 apparent_encoding（會對整個 body 跑 chardet）：
+    HTTP header 有給 charset（且不是 requests 預設的 ISO-8859-1）就用；
+    否則看前 4KB 的 <meta charset>；都沒有就 utf-8
+    """
+    enc = response.encoding
+    if not enc or enc.lower() == "iso-8859-1":
+        m = _META_CHARSET_RE.search(response.content[:4096])
+        enc = m.group(1).decode("ascii") if m else "utf-8"
+    try:
+        return codecs.lookup(enc).name
+    except LookupError:
+        return "utf-8"
+
+
+def copy_capped(src, dst, limit: int) -> int:
+    """
+    像 shutil.copyfileobj 一樣直接從 resp.raw 拷到檔案（重用同一塊 buffer，
+    不經 iter_content 產生一堆 bytes），但超過 limit 就提早中止。回傳寫入的 bytes。
+    """
+    buf = bytearray(64 * 1024)
+    view = memoryview(buf)
+    size = 0
+    while True:
+        n = src.readinto(buf)
+        if not n:
+            return size
+        size += n
+        if size > limit:
+            raise ValueError(f"Image too large: > {limit} bytes")
+        dst.write(view[:n])
@@ -3,11 +3,17 @@ import re
 import json
 import time
 import hashlib
+import queue
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from urllib.parse import urljoin, urlparse
 
 import requests
+import lxml.html
 from bs4 import BeautifulSoup
+from lxml import etree
 
+from crawl_utils import polite_wait, write_json
 
 BASE_URL = "http://www.optimumopt.com/"
 START_URL = BASE_URL + "?mod=product&col_key=product&lang=cn"
@@ -16,6 +22,35 @@ HOME_URL = BASE_URL + "?lang=cn"
 OUTPUT_DIR = "crawled_data"
 IMAGES_DIR = os.path.join(OUTPUT_DIR, "images")
 DATA_PATH = os.path.join(OUTPUT_DIR, "data.json")
+# filename -> {url, etag, last_modified, content_hash}：重跑時用來送條件式請求與內容去重
+IMAGES_META_PATH = os.path.join(OUTPUT_DIR, "images_meta.json")
+
+# 熱路徑用的 regex 先編好（\s 保留 Unicode，全形空白也要壓掉）
+_WS_RE = re.compile(r"\s+")
+_IMG_EXT_RE = re.compile(r"\.(?:png|jpe?g|webp|gif)$", re.IGNORECASE | re.ASCII)
+
+# 逐筆進度（JSONL，追加寫入）；中斷後重跑會先讀回來、略過已抓過的 URL，跑完寫出 data.json 後刪除
+PROGRESS_PATH = os.path.join(OUTPUT_DIR, "data.jsonl")
+# 每抓完幾個產品存一次 images_meta.json（整份重寫，不必每筆都存）
+META_SAVE_EVERY = max(1, int(os.getenv("CRAWL_META_SAVE_EVERY", "20")))
+
+# 公司資訊頁用的 XPath（在 libxml2 裡直接篩，不必逐個 <a> 跑 Python）
+_ABOUT_HREF_XP = etree.XPath('//a[@href][contains(normalize-space(string(.)), "關於尚澤")][1]/@href')
+# 依序嘗試：.about_content → .content → #main_content
+_ABOUT_CONTENT_XPS = tuple(
+    etree.XPath(x)
+    for x in (
+        '//*[contains(concat(" ", normalize-space(@class), " "), " about_content ")][1]',
+        '//*[contains(concat(" ", normalize-space(@class), " "), " content ")][1]',
+        '//*[@id="main_content"][1]',
+    )
+)
+_TEXT_XP = etree.XPath(".//text()[not(ancestor::script) and not(ancestor::style)]")
+
+# 同時抓取的頁面數
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", "8"))
+# 解析產品頁（含下載內容圖）的 thread 數
+PARSE_WORKERS = max(1, int(os.getenv("CRAWL_PARSE_WORKERS", "2")))
 
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
@@ -26,26 +61,66 @@ SESSION.headers.update({
 })
 
 
+def load_images_meta() -> dict:
+    try:
+        with open(IMAGES_META_PATH, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return meta if isinstance(meta, dict) else {}
+    except Exception:
+        return {}
+
+
+def save_images_meta() -> None:
+    with _META_LOCK:
+        snapshot = dict(IMAGES_META)
+    tmp_path = IMAGES_META_PATH + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, IMAGES_META_PATH)
+
+
+IMAGES_META = load_images_meta()
+_META_LOCK = threading.Lock()  # 產品詳情並行抓取時，圖片 meta 會被多個 thread 更新
+# content_hash -> filename（同內容不同檔名的圖只存一份）
+CONTENT_INDEX = {
+    m["content_hash"]: fn for fn, m in IMAGES_META.items()
+    if isinstance(m, dict) and m.get("content_hash") and not m.get("alias_of")
+}
+
+
 def clean_text(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    return _WS_RE.sub(" ", (s or "").strip())
 
 
-def get_soup(url: str) -> BeautifulSoup | None:
+def fetch_html(url: str) -> str | None:
     for attempt in range(3):
         try:
+            polite_wait()
             r = SESSION.get(url, timeout=20)
             r.raise_for_status()
             # 有些頁面用 utf-8，但也可能是 big5；用 apparent_encoding 較穩
             r.encoding = r.apparent_encoding or "utf-8"
-            return BeautifulSoup(r.text, "lxml")
+            return r.text
         except Exception as e:
             print(f"[get_soup] {url} attempt {attempt+1}/3 failed: {e}")
             time.sleep(1.5)
     return None
 
 
+def get_soup(url: str) -> BeautifulSoup | None:
+    html = fetch_html(url)
+    return BeautifulSoup(html, "lxml") if html is not None else None
+
+
+def url_hash_filename(full_url: str) -> str:
+    """URL 沒有檔名時用 hash 當檔名；舊版用 md5 存過的檔案沿用原檔名"""
+    data = full_url.encode("utf-8")
+    legacy = hashlib.md5(data).hexdigest() + ".jpg"
+    if os.path.exists(os.path.join(IMAGES_DIR, legacy)):
+        return legacy
+    return hashlib.blake2b(data, digest_size=16).hexdigest() + ".jpg"
+
+
 def is_probably_ui_asset(filename: str) -> bool:
     """避免下載 icon/小圖/介面圖（可依實際站台再調）"""
     name = filename.lower()
@@ -63,34 +138,93 @@ def download_image(img_url: str) -> str | None:
 
     if not filename:
         # 用 URL hash 當檔名（避免無檔名）
-        filename = hashlib.md5(full_url.encode("utf-8")).hexdigest() + ".jpg"
+        filename = url_hash_filename(full_url)
 
     # 過濾非圖片
-    if not re.search(r"\.(png|jpg|jpeg|webp|gif)$", filename, re.IGNORECASE):
+    if not _IMG_EXT_RE.search(filename):
         return None
 
     if is_probably_ui_asset(filename):
         return None
 
     save_path = os.path.join(IMAGES_DIR, filename)
-    if os.path.exists(save_path):
-        return filename  # ✅ 回傳相對檔名（給後端 /images/<filename> 用）
-
+    meta = IMAGES_META.get(filename) or {}
+    # 本機已有的檔名：自己的檔，或上次內容去重後沿用的那個檔（alias_of）
+    # alias_of 的檔之後若被換成別的內容，content_hash 對不上就不能再沿用
+    local = filename if os.path.exists(save_path) else None
+    alias = meta.get("alias_of")
+    if (local is None and alias and os.path.exists(os.path.join(IMAGES_DIR, alias))
+            and (IMAGES_META.get(alias) or {}).get("content_hash") == meta.get("content_hash")):
+        local = alias
+    exists = local is not None
+
+    headers = {}
+    if exists:
+        # 沒有 ETag/Last-Modified 可驗證 → 維持原本「有檔就跳過」
+        if not (meta.get("etag") or meta.get("last_modified")):
+            return local  # ✅ 回傳相對檔名（給後端 /images/<filename> 用）
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    # 每個 thread 各自的 tmp，避免兩個產品頁同時下載同一張圖互相覆寫
+    tmp_path = f"{save_path}.{threading.get_ident()}.tmp"
     try:
-        r = SESSION.get(full_url, stream=True, timeout=30)
-        if r.status_code != 200:
-            return None
-
-        with open(save_path, "wb") as f:
-            for chunk in r.iter_content(1024 * 64):
-                if chunk:
-                    f.write(chunk)
+        with SESSION.get(full_url, headers=headers, stream=True, timeout=30) as r:
+            if r.status_code == 304 and exists:
+                return local  # 伺服器確認未變更，沒有 body
+            if r.status_code != 200:
+                return None
+
+            h = hashlib.blake2b()
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(1024 * 64):
+                    if chunk:
+                        h.update(chunk)
+                        f.write(chunk)
+            content_hash = h.hexdigest()
+            etag = r.headers.get("ETag", "")
+            last_modified = r.headers.get("Last-Modified", "")
+
+        with _META_LOCK:
+            # 內容去重：同一張圖已用別的檔名存過，就沿用那個檔名
+            same = CONTENT_INDEX.get(content_hash)
+            if (same and same != filename
+                    and (IMAGES_META.get(same) or {}).get("content_hash") == content_hash
+                    and os.path.exists(os.path.join(IMAGES_DIR, same))):
+                os.remove(tmp_path)
+                # 這個 URL 的驗證資訊也記下來，下次才能用條件式 GET 直接拿到 same
+                IMAGES_META[filename] = {
+                    "url": full_url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "content_hash": content_hash,
+                    "alias_of": same,
+                }
+                print(f"Dedup image: {filename} -> {same}")
+                return same
+
+            os.replace(tmp_path, save_path)
+            # 檔案內容換了：舊 hash 不能再指向這個檔，否則之後同舊內容的圖會被錯誤沿用
+            old_hash = (IMAGES_META.get(filename) or {}).get("content_hash")
+            if old_hash and old_hash != content_hash and CONTENT_INDEX.get(old_hash) == filename:
+                del CONTENT_INDEX[old_hash]
+            IMAGES_META[filename] = {
+                "url": full_url,
+                "etag": etag,
+                "last_modified": last_modified,
+                "content_hash": content_hash,
+            }
+            CONTENT_INDEX[content_hash] = filename
 
         print(f"Downloaded image: {filename}")
         return filename
     except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         print(f"[download_image] {full_url} failed: {e}")
-        return None
+        return local
 
 
 def get_categories() -> list[dict]:
@@ -103,27 +237,30 @@ def get_categories() -> list[dict]:
     if not soup:
         return []
 
-    categories = []
-    seen = set()
-
-    for a in soup.select("a[href*='cate_id=']"):
-        href = a.get("href", "")
-        if "pro_id=" in href:
-            continue
-        name = clean_text(a.get_text())
-        if not name:
-            continue
-        full_url = urljoin(BASE_URL, href)
-        key = (name, full_url)
-        if key in seen:
-            continue
-        seen.add(key)
-        categories.append({"name": name, "url": full_url})
+    # (name, url) 當 key：dict 保序又去重，一次建完
+    named = ((clean_text(a.get_text()), urljoin(BASE_URL, a.get("href", "")))
+             for a in soup.select("a[href*='cate_id=']")
+             if "pro_id=" not in a.get("href", ""))
+    categories = list({
+        (name, full_url): {"name": name, "url": full_url}
+        for name, full_url in named if name
+    }.values())
 
     print(f"Found {len(categories)} categories.")
     return categories
 
 
+def _product_link_name(a) -> str:
+    name = clean_text(a.get_text())
+    if not name:
+        img = a.find("img")
+        if img and img.get("alt"):
+            name = clean_text(img.get("alt"))
+        elif a.get("title"):
+            name = clean_text(a.get("title"))
+    return name or ""
+
+
 def get_products_from_category(category_url: str) -> list[dict]:
     """
     抓該分類的產品列表：只抓 prodetail 連結，並以 URL 去重。
@@ -133,25 +270,14 @@ def get_products_from_category(category_url: str) -> list[dict]:
     if not soup:
         return []
 
-    products = []
-    seen = set()
-
-    for a in soup.select("a[href*='pro_id='][href*='t=prodetail']"):
-        href = a.get("href", "")
-        full_url = urljoin(BASE_URL, href)
-        if full_url in seen:
-            continue
-        seen.add(full_url)
-
-        name = clean_text(a.get_text())
-        if not name:
-            img = a.find("img")
-            if img and img.get("alt"):
-                name = clean_text(img.get("alt"))
-            elif a.get("title"):
-                name = clean_text(a.get("title"))
-
-        products.append({"name": name or "", "url": full_url})
+    pairs = [(urljoin(BASE_URL, a.get("href", "")), a)
+             for a in soup.select("a[href*='pro_id='][href*='t=prodetail']")]
+    # 反向建 dict → 同 URL 留下第一個出現的 <a>；順序再用 dict.fromkeys 保持原頁面順序
+    first_anchor = dict(reversed(pairs))
+    products = [
+        {"name": _product_link_name(first_anchor[full_url]), "url": full_url}
+        for full_url in dict.fromkeys(u for u, _ in pairs)
+    ]
 
     print(f"Found {len(products)} products in category.")
     return products
@@ -192,7 +318,10 @@ def get_product_details(product_url: str) -> dict | None:
     soup = get_soup(product_url)
     if not soup:
         return None
+    return parse_product_details(product_url, soup)
+
 
+def parse_product_details(product_url: str, soup: BeautifulSoup) -> dict:
     details = {
         "url": product_url,
         "title": "",
@@ -233,28 +362,151 @@ def get_product_details(product_url: str) -> dict | None:
     return details
 
 
+def load_progress() -> dict[str, dict]:
+    """上次中斷留下的 PROGRESS_PATH：url -> details"""
+    done: dict[str, dict] = {}
+    try:
+        with open(PROGRESS_PATH, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return done
+
+    # 中斷時可能留下寫一半的最後一行：截掉，之後追加的才不會接在它後面
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+        with open(PROGRESS_PATH, "r+b") as f:
+            f.truncate(end)
+
+    for line in data[:end].splitlines():
+        try:
+            d = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(d, dict) and d.get("url"):
+            done[d["url"]] = d
+    return done
+
+
+def crawl_products(url_to_prod: dict[str, tuple[str, str]]) -> list[dict]:
+    """
+    fetch → parse → write 三段管線，網路等待與解析互相重疊：
+    - CRAWL_WORKERS 個 thread 抓 HTML，放進 fetch_q
+    - PARSE_WORKERS 個 thread 解析（含下載內容圖），放進 parse_q
+    - 呼叫端 thread 當 writer：清洗後逐筆追加到 PROGRESS_PATH（JSONL）
+    queue 有上限，抓太快時會自動等解析跟上；None 是結束訊號。
+    PROGRESS_PATH 裡已有的 URL（上次中斷前抓完的）直接沿用，不再抓一次。
+    """
+    done = load_progress()
+    products: list[dict] = [d for url, d in done.items() if url in url_to_prod]
+    pending = [url for url in url_to_prod if url not in done]
+    if products:
+        print(f"Resuming: {len(products)} products from {PROGRESS_PATH}, {len(pending)} left.")
+
+    fetch_q: queue.Queue = queue.Queue(maxsize=32)
+    parse_q: queue.Queue = queue.Queue(maxsize=32)
+
+    def fetch_all() -> None:
+        # 最多 2×CRAWL_WORKERS 個請求在途：fetch_q 滿了 put 會卡住，也就不再補送新請求，
+        # 不會把所有 URL 一次丟進 pool、讓抓好的 HTML 全堆在 future 裡
+        urls = iter(pending)
+        with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as ex:
+            in_flight = {}
+            for url in urls:
+                in_flight[ex.submit(fetch_html, url)] = url
+                if len(in_flight) >= 2 * CRAWL_WORKERS:
+                    break
+            while in_flight:
+                finished_futs, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in finished_futs:
+                    fetch_q.put((in_flight.pop(fut), fut.result()))
+                    url = next(urls, None)
+                    if url is not None:
+                        in_flight[ex.submit(fetch_html, url)] = url
+        for _ in range(PARSE_WORKERS):
+            fetch_q.put(None)
+
+    def parse_worker() -> None:
+        while True:
+            item = fetch_q.get()
+            if item is None:
+                parse_q.put(None)
+                return
+            url, html = item
+            details = None
+            if html is not None:
+                print(f"Parsing details for {url}...")
+                try:
+                    details = parse_product_details(url, BeautifulSoup(html, "lxml"))
+                except Exception as e:
+                    print(f"[parse_product_details] {url} failed: {e}")
+            parse_q.put((url, details))
+
+    threads = [threading.Thread(target=fetch_all, daemon=True)]
+    threads += [threading.Thread(target=parse_worker, daemon=True) for _ in range(PARSE_WORKERS)]
+    for t in threads:
+        t.start()
+
+    finished = 0
+    fetched = 0
+    with open(PROGRESS_PATH, "a", encoding="utf-8") as progress:
+        while finished < PARSE_WORKERS:
+            item = parse_q.get()
+            if item is None:
+                finished += 1
+                continue
+            url, details = item
+            if not details:
+                continue
+
+            cat_name, list_name = url_to_prod[url]
+            details["category"] = cat_name or "未分類"
+
+            # 基本清洗
+            details["title"] = clean_text(details.get("title", "")) or clean_text(list_name)
+            details["description"] = clean_text(details.get("description", ""))
+            details["specifications"] = (details.get("specifications", "") or "").strip()
+
+            products.append(details)
+
+            # 每筆追加一行，避免中途掛掉全沒了
+            progress.write(json.dumps(details, ensure_ascii=False) + "\n")
+            progress.flush()
+            fetched += 1
+            if fetched % META_SAVE_EVERY == 0:
+                save_images_meta()
+
+    for t in threads:
+        t.join()
+
+    # 完成順序不固定；排回分類列表的順序，data.json 才穩定
+    order = {url: i for i, url in enumerate(url_to_prod)}
+    products.sort(key=lambda d: order.get(d["url"], len(order)))
+    return products
+
+
 def get_company_info() -> dict:
     print("Fetching company info...")
-    soup = get_soup(HOME_URL)
-    if not soup:
+    html = fetch_html(HOME_URL)
+    if html is None:
         return {}
 
-    about_url = None
-    for a in soup.find_all("a", href=True):
-        if "關於尚澤" in clean_text(a.get_text()):
-            about_url = urljoin(BASE_URL, a["href"])
-            break
-
-    if not about_url:
+    hrefs = _ABOUT_HREF_XP(lxml.html.document_fromstring(html))
+    if not hrefs:
         print("Could not find About Us link.")
         return {}
+    about_url = urljoin(BASE_URL, hrefs[0])
 
-    soup = get_soup(about_url)
-    if not soup:
+    html = fetch_html(about_url)
+    if html is None:
         return {}
 
-    content_div = soup.select_one(".about_content") or soup.select_one(".content") or soup.select_one("#main_content")
-    content = clean_text(content_div.get_text("\n", strip=True)) if content_div else ""
+    doc = lxml.html.document_fromstring(html)
+    content = ""
+    for xp in _ABOUT_CONTENT_XPS:
+        found = xp(doc)
+        if found:
+            content = clean_text(" ".join(_TEXT_XP(found[0])))
+            break
 
     return {"url": about_url, "content": content}
 
@@ -267,37 +519,24 @@ def main():
 
     categories = get_categories()
 
-    seen_products = set()  # 以 URL 去重
+    # Phase 1：分類列表並行抓，先收齊 (url -> 分類, 列表名稱)，第一個出現的分類為準
+    with ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as ex:
+        listings = list(ex.map(lambda c: get_products_from_category(c["url"]), categories))
 
-    for cat in categories:
+    url_to_prod: dict[str, tuple[str, str]] = {}
+    for cat, cat_products in zip(categories, listings):
         cat_name = clean_text(cat["name"])
-        cat_products = get_products_from_category(cat["url"])
-
         for prod in cat_products:
-            url = prod["url"]
-            if url in seen_products:
-                continue
-            seen_products.add(url)
-
-            details = get_product_details(url)
-            if not details:
-                continue
-
-            details["category"] = cat_name or "未分類"
-
-            # 基本清洗
-            details["title"] = clean_text(details.get("title", "")) or clean_text(prod.get("name", ""))
-            details["description"] = clean_text(details.get("description", ""))
-            details["specifications"] = (details.get("specifications", "") or "").strip()
-
-            all_data["products"].append(details)
+            url_to_prod.setdefault(prod["url"], (cat_name, prod.get("name", "")))
 
-            # 每筆存一次，避免中途掛掉全沒了
-            with open(DATA_PATH, "w", encoding="utf-8") as f:
-                json.dump(all_data, f, ensure_ascii=False, indent=2)
+    print(f"Unique products across categories: {len(url_to_prod)}")
 
-            time.sleep(0.8)  # polite
+    # Phase 2：去重後的產品詳情走 fetch/parse 管線（worker 數即禮貌上限）
+    all_data["products"] = crawl_products(url_to_prod)
 
+    write_json(DATA_PATH, all_data)
+    save_images_meta()
+    os.remove(PROGRESS_PATH)
     print(f"Crawling finished. Saved to {DATA_PATH}")
     print(f"Total products: {len(all_data['products'])}")
 
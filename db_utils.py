@@ -0,0 +1,17 @@
+import sqlite3
+
+
+def open_db(path: str, timeout: float = 30) -> sqlite3.Connection:
+    """
+    統一的 SQLite 連線：
+    - WAL：寫入不擋讀取，commit 不必每次 fsync 主檔
+    - synchronous=NORMAL：WAL 下仍安全，只在 checkpoint 時 fsync
+    - temp_store / cache_size / mmap_size：排序、暫存表與讀取盡量走記憶體
+    """
+    conn = sqlite3.connect(path, timeout=timeout)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")  # 約 64MB
+    conn.execute("PRAGMA mmap_size=268435456")  # 256MB
+    return conn
@@ -21,6 +21,7 @@ def _has_any(text: str, keys: List[str]) -> bool:
 
 MODEL_RE = re.compile(r"\b([A-Za-z]{1,}\-?\d{2,}[A-Za-z0-9\-]*)\b")
 VS_RE = re.compile(r"\b(vs\.?|versus)\b", re.IGNORECASE)
+WS_RE = re.compile(r"\s+")
 
 # numbers / units / wavelength
 NM_RE = re.compile(r"(\d{2,4})\s*nm\b", re.IGNORECASE)
@@ -219,6 +220,44 @@ def advance(state: Dict[str, Any], user_text: str) -> Tuple[Dict[str, Any], str]
 # -----------------------------
 # Recommendation query terms
 # -----------------------------
+# ✅ 核心詞彙：補齊你常見的命中低問題
+VOCAB = [
+    # bands
+    "UVC", "UVB", "UVA", "VIS", "NIR", "IR", "PAR",
+    # plant lighting
+    "PPFD", "PPF", "PAR", "光子通量", "光合光子", "植物照明", "植物燈",
+    # irradiance / intensity
+    "輻照度", "irradiance", "radiometer", "光強度", "強度", "照度", "lux", "illuminance",
+    # luminance
+    "輝度", "luminance", "亮度", "nit", "cd/m2",
+    # spectrum
+    "光譜", "spectrum", "spectrometer", "波長",
+    # integrating sphere / flux
+    "積分球", "總光通量", "光通量", "lumen", "lm",
+    # reflect / transmit
+    "反射率", "reflectance", "穿透率", "透過率", "transmittance", "鏡面", "玻璃",
+    # phosphor
+    "螢光粉", "phosphor",
+    # objects / industries
+    "UVC LED", "LED", "雷射", "laser", "顯示器", "display", "醫療燈",
+    # scenario
+    "產線", "品管", "研發", "自動化", "報表", "暗箱", "校正", "校準",
+]
+
+# 全部詞彙編成一個 regex（長詞優先），一次掃過輸入；用 lookahead 讓重疊的詞也找得到
+_VOCAB_LOWER = sorted({w.lower() for w in VOCAB}, key=len, reverse=True)
+_VOCAB_RE = re.compile("(?=(" + "|".join(map(re.escape, _VOCAB_LOWER)) + "))")
+# 同一起點只會命中最長的詞，較短的前綴詞（PPF ⊂ PPFD、UVC ⊂ UVC LED）由這張表補上
+_VOCAB_PREFIXES = {w: [v for v in _VOCAB_LOWER if w.startswith(v)] for w in _VOCAB_LOWER}
+
+
+def _vocab_hits(lower: str) -> set:
+    hits = set()
+    for m in _VOCAB_RE.finditer(lower):
+        hits.update(_VOCAB_PREFIXES[m.group(1)])
+    return hits
+
+
 def build_recommendation_query_terms(state: Dict[str, Any]) -> List[str]:
     """
     把 3 題答案轉成檢索關鍵字（讓 app.py 用它去做 RAG/DB/BM25 搜尋）
@@ -227,40 +266,13 @@ def build_recommendation_query_terms(state: Dict[str, Any]) -> List[str]:
     """
     ans = state.get("answers") or {}
     parts = [str(v).strip() for v in ans.values() if str(v).strip()]
-    raw = re.sub(r"\s+", " ", " ".join(parts)).strip()
+    raw = WS_RE.sub(" ", " ".join(parts)).strip()
     if not raw:
         return []
 
-    # ✅ 核心詞彙：補齊你常見的命中低問題
-    vocab = [
-        # bands
-        "UVC", "UVB", "UVA", "VIS", "NIR", "IR", "PAR",
-        # plant lighting
-        "PPFD", "PPF", "PAR", "光子通量", "光合光子", "植物照明", "植物燈",
-        # irradiance / intensity
-        "輻照度", "irradiance", "radiometer", "光強度", "強度", "照度", "lux", "illuminance",
-        # luminance
-        "輝度", "luminance", "亮度", "nit", "cd/m2",
-        # spectrum
-        "光譜", "spectrum", "spectrometer", "波長",
-        # integrating sphere / flux
-        "積分球", "總光通量", "光通量", "lumen", "lm",
-        # reflect / transmit
-        "反射率", "reflectance", "穿透率", "透過率", "transmittance", "鏡面", "玻璃",
-        # phosphor
-        "螢光粉", "phosphor",
-        # objects / industries
-        "UVC LED", "LED", "雷射", "laser", "顯示器", "display", "醫療燈",
-        # scenario
-        "產線", "品管", "研發", "自動化", "報表", "暗箱", "校正", "校準",
-    ]
-
     lower = raw.lower()
-
-    keep: List[str] = []
-    for w in vocab:
-        if w.lower() in lower:
-            keep.append(w)
+    hits = _vocab_hits(lower)
+    keep: List[str] = [w for w in VOCAB if w.lower() in hits]
 
     # ✅ 抽取 nm
     nms = NM_RE.findall(raw)
@@ -274,11 +286,11 @@ def build_recommendation_query_terms(state: Dict[str, Any]) -> List[str]:
 
     # ✅ 組合詞（提高檢索命中：例如 "UVC 輻照度", "PPFD 植物照明"）
     combos: List[str] = []
-    if any(x.lower() in lower for x in ["uvc", "uvb", "uva"]):
-        if any(x.lower() in lower for x in ["輻照度", "irradiance", "radiometer", "光強度", "強度"]):
+    if hits & {"uvc", "uvb", "uva"}:
+        if hits & {"輻照度", "irradiance", "radiometer", "光強度", "強度"}:
             combos.append("UVC 輻照度")
         combos.append("紫外線 光譜")
-    if any(x.lower() in lower for x in ["ppfd", "ppf", "par", "植物"]):
+    if hits & {"ppfd", "ppf", "par"} or "植物" in lower:
         combos.append("PPFD 植物照明")
         combos.append("PAR 光子通量")
 
@@ -8,11 +8,19 @@ from urllib.parse import urljoin, urlparse
 import requests
 from bs4 import BeautifulSoup
 
+from crawl_utils import append_partial, load_partial, read_json, write_json
 
 BASE_URL = "http://www.optimumopt.com/"
 DATA_FILE = "crawled_data/data.json"
 IMAGES_DIR = "crawled_data/images"
 
+_WS_RE = re.compile(r"\s+")
+_QS_FRAG_RE = re.compile(r"[?#].*$")
+_BAD_CHARS_RE = re.compile(r"[^A-Za-z0-9._-]", re.ASCII)
+_IMG_EXT_RE = re.compile(r"\.(?:png|jpe?g|webp|gif)$", re.IGNORECASE | re.ASCII)
+# 執行中的逐筆進度（JSONL，每支腳本各自一份）；正常結束時合併回 data.json 後刪除
+PARTIAL_FILE = "crawled_data/data.download_all.partial.jsonl"
+
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
 S = requests.Session()
@@ -35,22 +43,31 @@ def get_soup(url: str) -> BeautifulSoup | None:
     return None
 
 
+def url_hash_filename(full_url: str) -> str:
+    """URL 沒有檔名時用 hash 當檔名；舊版用 md5 存過的檔案沿用原檔名"""
+    data = full_url.encode("utf-8")
+    legacy = hashlib.md5(data).hexdigest() + ".jpg"
+    if os.path.exists(os.path.join(IMAGES_DIR, legacy)):
+        return legacy
+    return hashlib.blake2b(data, digest_size=16).hexdigest() + ".jpg"
+
+
 def safe_filename_from_url(full_url: str) -> str:
     """把 URL 變成安全檔名（避免包含 / 造成子資料夾）"""
     path = urlparse(full_url).path
     name = os.path.basename(path)
 
     if not name:
-        name = hashlib.md5(full_url.encode("utf-8")).hexdigest() + ".jpg"
+        name = url_hash_filename(full_url)
 
     # 去除 query 殘留
-    name = name.split("?")[0].split("#")[0]
+    name = _QS_FRAG_RE.sub("", name)
 
     # 若檔名仍含奇怪字元，做簡化
-    name = re.sub(r"[^A-Za-z0-9._-]", "_", name)
+    name = _BAD_CHARS_RE.sub("_", name)
 
     # 若沒副檔名，補 jpg
-    if not re.search(r"\.(png|jpg|jpeg|webp|gif)$", name, re.IGNORECASE):
+    if not _IMG_EXT_RE.search(name):
         name += ".jpg"
 
     return name
@@ -78,9 +95,7 @@ def download_image(full_img_url: str) -> str | None:
 
 
 def clean_text(s: str) -> str:
-    s = (s or "").strip()
-    s = re.sub(r"\s+", " ", s)
-    return s
+    return _WS_RE.sub(" ", (s or "").strip())
 
 
 def split_desc_specs(raw_text: str) -> tuple[str, str]:
@@ -185,8 +200,8 @@ def update_data_json():
         print(f"❌ 錯誤: 找不到 {DATA_FILE}")
         return
 
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    src_mtime = os.stat(DATA_FILE).st_mtime_ns
+    data = read_json(DATA_FILE)
 
     products = data.get("products", [])
     print(f"\n{'='*60}\n共有 {len(products)} 個商品需要處理\n{'='*60}\n")
@@ -195,48 +210,59 @@ def update_data_json():
     updated_count = 0
     total_new_images = 0
 
-    for i, product in enumerate(products):
-        url = product.get("url")
-        if not url:
-            continue
-
-        if url in processed_urls:
-            print(f"[{i+1}/{len(products)}] ⏭️  跳過重複 URL")
-            continue
-        processed_urls.add(url)
-
-        title = product.get("title") or "Unknown"
-        print(f"\n{'='*60}\n[{i+1}/{len(products)}] 商品: {title}")
-
-        old_images = product.get("images") or []
-        if isinstance(old_images, str):
-            try:
-                old_images = json.loads(old_images)
-            except Exception:
-                old_images = []
-        old_image_count = len(old_images)
-
-        details = extract_and_download_all_images(url)
-        if details:
-            product["description"] = details["description"]
-            product["images"] = details["images"]          # ✅ 存檔名 list
-            product["specifications"] = details["specifications"]
+    done = load_partial(PARTIAL_FILE, src_mtime)
+    if done:
+        print(f"♻️  從 {PARTIAL_FILE} 接續：{len(done)} 個商品上次已完成")
 
-            new_image_count = len(details["images"])
-            if new_image_count > old_image_count:
-                total_new_images += (new_image_count - old_image_count)
+    with open(PARTIAL_FILE, "a", encoding="utf-8") as partial:
+        for i, product in enumerate(products):
+            url = product.get("url")
+            if not url:
+                continue
 
-            updated_count += 1
+            if url in processed_urls:
+                print(f"[{i+1}/{len(products)}] ⏭️  跳過重複 URL")
+                continue
+            processed_urls.add(url)
 
-            if updated_count % 5 == 0:
-                with open(DATA_FILE, "w", encoding="utf-8") as f:
-                    json.dump(data, f, ensure_ascii=False, indent=2)
-                print(f"  💾 已保存進度（{updated_count} 個商品已更新）")
+            title = product.get("title") or "Unknown"
+            print(f"\n{'='*60}\n[{i+1}/{len(products)}] 商品: {title}")
 
-        time.sleep(1)
+            if url in done:
+                product.update(done[url])
+                print("  ♻️  上次已完成，直接套用紀錄")
+                updated_count += 1
+                continue
 
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+            old_images = product.get("images") or []
+            if isinstance(old_images, str):
+                try:
+                    old_images = json.loads(old_images)
+                except Exception:
+                    old_images = []
+            old_image_count = len(old_images)
+
+            details = extract_and_download_all_images(url)
+            if details:
+                product["description"] = details["description"]
+                product["images"] = details["images"]          # ✅ 存檔名 list
+                product["specifications"] = details["specifications"]
+                append_partial(partial, url, src_mtime, {
+                    "description": product["description"],
+                    "images": product["images"],
+                    "specifications": product["specifications"],
+                })
+
+                new_image_count = len(details["images"])
+                if new_image_count > old_image_count:
+                    total_new_images += (new_image_count - old_image_count)
+
+                updated_count += 1
+
+            time.sleep(1)
+
+    write_json(DATA_FILE, data)
+    os.remove(PARTIAL_FILE)
 
     total_images = sum(len(p.get("images") or []) for p in products)
     products_with_images = sum(1 for p in products if p.get("images"))
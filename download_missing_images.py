@@ -6,9 +6,18 @@ import re
 from urllib.parse import urljoin, urlparse
 import time
 
+from crawl_utils import append_partial, load_partial, read_json, write_json
+
 BASE_URL = "http://www.optimumopt.com/"
 DATA_FILE = "crawled_data/data.json"
 IMAGES_DIR = "crawled_data/images"
+# 執行中的逐筆進度（JSONL，每支腳本各自一份）；正常結束時合併回 data.json 後刪除
+PARTIAL_FILE = "crawled_data/data.download_missing.partial.jsonl"
+
+_QS_FRAG_RE = re.compile(r"[?#].*$")
+_GEN2_PREFIX_RE = re.compile(r"^/gen2/\d+/")
+_IMG_EXT_RE = re.compile(r"\.(?:png|jpe?g|webp|gif)$", re.IGNORECASE | re.ASCII)
+_MULTI_NL_RE = re.compile(r"\n{3,}")
 
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
@@ -43,8 +52,7 @@ def safe_filename_from_src(src: str) -> str | None:
     if not src:
         return None
 
-    src = src.split("?")[0].split("#")[0]
-    src = re.sub(r"^/gen2/\d+/", "/", src)
+    src = _GEN2_PREFIX_RE.sub("/", _QS_FRAG_RE.sub("", src))
 
     if "uploads/" not in src:
         return None
@@ -57,7 +65,7 @@ def safe_filename_from_src(src: str) -> str | None:
         return None
 
     # 只接受常見圖片副檔名
-    if not re.search(r"\.(png|jpg|jpeg|webp|gif)$", filename, re.IGNORECASE):
+    if not _IMG_EXT_RE.search(filename):
         return None
 
     return filename
@@ -97,7 +105,7 @@ def extract_and_download_images(url):
 
     # 描述：保留原本做法，但避免超多空白
     text = detail_div.get_text(separator="\n", strip=True)
-    text = re.sub(r"\n{3,}", "\n\n", text)
+    text = _MULTI_NL_RE.sub("\n\n", text)
     result["description"] = text
 
     images = []
@@ -139,8 +147,8 @@ def update_data_json():
         print(f"❌ 錯誤: 找不到 {DATA_FILE}")
         return
 
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    src_mtime = os.stat(DATA_FILE).st_mtime_ns
+    data = read_json(DATA_FILE)
 
     products = data.get("products", [])
     print(f"\n{'='*60}\n共有 {len(products)} 個商品需要處理\n{'='*60}\n")
@@ -149,57 +157,68 @@ def update_data_json():
     updated_count = 0
     downloaded_new_images = 0
 
-    for i, product in enumerate(products):
-        url = product.get("url")
-        if not url:
-            continue
-
-        if url in processed_urls:
-            print(f"[{i+1}/{len(products)}] ⏭️  跳過重複 URL: {product.get('title', 'Unknown')}")
-            continue
-        processed_urls.add(url)
-
-        print(f"\n{'='*60}")
-        print(f"[{i+1}/{len(products)}] 商品: {product.get('title', 'Unknown')}")
-
-        # 需要更新：description 空 或 images 空
-        needs_update = (not product.get("description")) or (not product.get("images"))
-        if not needs_update:
-            print("  ℹ️  此商品已有完整資料，跳過...")
-            continue
-
-        # 先記錄更新前已有多少圖片檔名
-        old_images = product.get("images") or []
-        if isinstance(old_images, str):
-            try:
-                old_images = json.loads(old_images)
-            except Exception:
-                old_images = []
-        old_set = set(old_images) if isinstance(old_images, list) else set()
-
-        details = extract_and_download_images(url)
-        if details is None:
-            continue
-
-        product["description"] = details.get("description", "")
-        product["images"] = details.get("images", [])          # ✅ 檔名 list
-        product["specifications"] = details.get("specifications", "")
-
-        # 只算新增加的圖片數（避免統計失真）
-        new_set = set(product["images"])
-        downloaded_new_images += max(0, len(new_set - old_set))
-
-        updated_count += 1
-
-        if updated_count % 5 == 0:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"\n  💾 已保存進度 ({updated_count} 個商品已更新)")
-
-        time.sleep(1)
-
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    done = load_partial(PARTIAL_FILE, src_mtime)
+    if done:
+        print(f"♻️  從 {PARTIAL_FILE} 接續：{len(done)} 個商品上次已完成")
+
+    with open(PARTIAL_FILE, "a", encoding="utf-8") as partial:
+        for i, product in enumerate(products):
+            url = product.get("url")
+            if not url:
+                continue
+
+            if url in processed_urls:
+                print(f"[{i+1}/{len(products)}] ⏭️  跳過重複 URL: {product.get('title', 'Unknown')}")
+                continue
+            processed_urls.add(url)
+
+            print(f"\n{'='*60}")
+            print(f"[{i+1}/{len(products)}] 商品: {product.get('title', 'Unknown')}")
+
+            if url in done:
+                product.update(done[url])
+                print("  ♻️  上次已完成，直接套用紀錄")
+                updated_count += 1
+                continue
+
+            # 需要更新：description 空 或 images 空
+            needs_update = (not product.get("description")) or (not product.get("images"))
+            if not needs_update:
+                print("  ℹ️  此商品已有完整資料，跳過...")
+                continue
+
+            # 先記錄更新前已有多少圖片檔名
+            old_images = product.get("images") or []
+            if isinstance(old_images, str):
+                try:
+                    old_images = json.loads(old_images)
+                except Exception:
+                    old_images = []
+            old_set = set(old_images) if isinstance(old_images, list) else set()
+
+            details = extract_and_download_images(url)
+            if details is None:
+                continue
+
+            product["description"] = details.get("description", "")
+            product["images"] = details.get("images", [])          # ✅ 檔名 list
+            product["specifications"] = details.get("specifications", "")
+            append_partial(partial, url, src_mtime, {
+                "description": product["description"],
+                "images": product["images"],
+                "specifications": product["specifications"],
+            })
+
+            # 只算新增加的圖片數（避免統計失真）
+            new_set = set(product["images"])
+            downloaded_new_images += max(0, len(new_set - old_set))
+
+            updated_count += 1
+
+            time.sleep(1)
+
+    write_json(DATA_FILE, data)
+    os.remove(PARTIAL_FILE)
 
     print(f"\n{'='*60}")
     print("✅ 完成！")
@@ -1,36 +1,55 @@
 import requests
-from bs4 import BeautifulSoup
-import json
+import lxml.html
+from lxml import etree
 import os
 import re
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlparse
 
+from crawl_utils import (
+    append_partial, copy_capped, load_partial, mount_retry_adapter, polite_wait, read_json, response_encoding,
+    write_json,
+)
+
 BASE_URL = "http://www.optimumopt.com/"
 DATA_FILE = "crawled_data/data.json"
 IMAGES_DIR = "crawled_data/images"
+# 逐筆進度（append-only JSONL），中斷後重跑會先套用；完成寫出 data.json 後刪除
+PARTIAL_FILE = "crawled_data/data.partial.jsonl"
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))  # 15MB
+# 同時處理的商品頁數
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+# 商品頁請求的間隔（秒），所有 worker 共用；與原本每頁 sleep(1) 同樣的請求速率
+EXTRACT_DELAY = float(os.getenv("EXTRACT_DELAY", "1"))
 
 os.makedirs(IMAGES_DIR, exist_ok=True)
 
-SESSION = requests.Session()
+_GEN2_PREFIX_RE = re.compile(r"^/gen2/\d+/")
+_IMG_EXT_RE = re.compile(r"\.(png|jpg|jpeg|webp|gif)$", re.IGNORECASE)
+# 商品詳情區與其中的圖片 src、可見文字（BS get_text 同樣不含 script/style/template）
+_DETAIL_XP = etree.XPath('(//div[@id="info-cnt-0"])[1]')
+_DETAIL_IMG_SRC_XP = etree.XPath(".//img/@src")
+_DETAIL_TEXT_XP = etree.XPath(".//text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+
+SESSION = mount_retry_adapter(requests.Session())
 SESSION.headers.update({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
                   "(KHTML, like Gecko) Chrome/120.0 Safari/537.36"
 })
 
 
-def get_soup(url):
-    """獲取網頁內容並解析為 BeautifulSoup 對象"""
-    for attempt in range(3):
-        try:
-            response = SESSION.get(url, timeout=20)
-            response.raise_for_status()
-            response.encoding = response.apparent_encoding or "utf-8"
-            return BeautifulSoup(response.text, "lxml")
-        except Exception as e:
-            print(f"Error fetching {url} (attempt {attempt+1}/3): {e}")
-            time.sleep(1.2)
-    return None
+def get_root(url):
+    """獲取網頁內容並用 lxml.html 解析（重試交給 SESSION 的 adapter）"""
+    polite_wait(EXTRACT_DELAY)
+    try:
+        response = SESSION.get(url, timeout=20)
+        response.raise_for_status()
+        parser = lxml.html.HTMLParser(encoding=response_encoding(response))
+        return lxml.html.document_fromstring(response.content, parser=parser)
+    except Exception as e:
+        print(f"Error fetching {url}: {e}")
+        return None
 
 
 def safe_filename(img_src: str) -> str | None:
@@ -39,7 +58,7 @@ def safe_filename(img_src: str) -> str | None:
         return None
 
     img_src = img_src.split("?")[0].split("#")[0]
-    img_src = re.sub(r"^/gen2/\d+/", "/", img_src)
+    img_src = _GEN2_PREFIX_RE.sub("/", img_src)
 
     if "uploads/" not in img_src:
         return None
@@ -51,7 +70,7 @@ def safe_filename(img_src: str) -> str | None:
         return None
 
     # 只接受圖片副檔名
-    if not re.search(r"\.(png|jpg|jpeg|webp|gif)$", filename, re.IGNORECASE):
+    if not _IMG_EXT_RE.search(filename):
         return None
 
     return filename
@@ -59,6 +78,7 @@ def safe_filename(img_src: str) -> str | None:
 
 def download_image(img_src: str, filename: str) -> bool:
     """下載圖片到本地 images 資料夾（img_src 可相對路徑）"""
+    tmp_path = None
     try:
         full_url = urljoin(BASE_URL, img_src)
         save_path = os.path.join(IMAGES_DIR, filename)
@@ -66,12 +86,18 @@ def download_image(img_src: str, filename: str) -> bool:
         if os.path.exists(save_path):
             return True
 
-        resp = SESSION.get(full_url, timeout=30)
-        resp.raise_for_status()
-        with open(save_path, "wb") as f:
-            f.write(resp.content)
+        # 多個商品頁可能同時下載同一張圖：各寫各的 tmp，再原子替換
+        tmp_path = f"{save_path}.{threading.get_ident()}.tmp"
+        with SESSION.get(full_url, timeout=30, stream=True) as resp:
+            resp.raise_for_status()
+            resp.raw.decode_content = True
+            with open(tmp_path, "wb") as f:
+                copy_capped(resp.raw, f, IMAGE_MAX_BYTES)
+        os.replace(tmp_path, save_path)
         return True
     except Exception as e:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
         print(f"  ❌ 下載失敗: {img_src} -> {filename}: {e}")
         return False
 
@@ -79,26 +105,28 @@ def download_image(img_src: str, filename: str) -> bool:
 def extract_product_detail(url):
     """從商品頁面提取詳細資訊"""
     print(f"\n正在處理: {url}")
-    soup = get_soup(url)
-    if not soup:
+    root = get_root(url)
+    if root is None:
         return None
 
     result = {"description": "", "images": [], "specifications": ""}
 
-    detail_div = soup.find("div", {"id": "info-cnt-0"})
-    if not detail_div:
+    found = _DETAIL_XP(root)
+    if not found:
         print("  ⚠️  未找到產品詳情區域 (info-cnt-0)")
         return result
+    detail_div = found[0]
 
-    # 描述（保留你的做法）
-    result["description"] = detail_div.get_text(strip=True, separator="\n")
+    # 描述（保留你的做法：每段文字 strip 後以換行串起）
+    result["description"] = "\n".join(
+        t for t in (s.strip() for s in _DETAIL_TEXT_XP(detail_div)) if t
+    )
 
     images = []
     seen = set()
 
-    for img in detail_div.find_all("img"):
-        src = img.get("src") or ""
-        filename = safe_filename(src)
+    for src in _DETAIL_IMG_SRC_XP(detail_div):
+        filename = safe_filename(str(src))
         if not filename:
             continue
 
@@ -124,14 +152,19 @@ def update_data_json():
         print(f"錯誤: 找不到 {DATA_FILE}")
         return
 
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    src_mtime = os.stat(DATA_FILE).st_mtime_ns
+    data = read_json(DATA_FILE)
 
     products = data.get("products", [])
     print(f"\n共有 {len(products)} 個商品需要處理\n")
 
     processed_urls = set()
     updated_count = 0
+    todo = []
+
+    done = load_partial(PARTIAL_FILE, src_mtime)
+    if done:
+        print(f"♻️  從 {PARTIAL_FILE} 讀回 {len(done)} 筆已完成的商品")
 
     for i, product in enumerate(products):
         url = product.get("url")
@@ -146,30 +179,39 @@ def update_data_json():
         print(f"\n{'='*60}")
         print(f"[{i+1}/{len(products)}] 商品: {product.get('title', 'Unknown')}")
 
+        if url in done:
+            product.update(done[url])
+            print("  ♻️  上次已完成，直接套用紀錄")
+            continue
+
         # 如果已經有描述和圖片，跳過
         if product.get("description") and product.get("images"):
             print("  ℹ️  此商品已有資料，跳過...")
             continue
 
-        details = extract_product_detail(url)
-        if details is None:
-            continue
-
-        product["description"] = details.get("description", "")
-        product["images"] = details.get("images", [])          # ✅ 存檔名 list
-        product["specifications"] = details.get("specifications", "")
-
-        updated_count += 1
-
-        if updated_count % 5 == 0:
-            with open(DATA_FILE, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"\n  💾 已保存進度 ({updated_count} 個商品已更新)")
-
-        time.sleep(1)
-
-    with open(DATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+        todo.append(product)
+
+    # 商品頁並行抓取；結果按原順序回到主 thread 寫回並追加進度
+    with open(PARTIAL_FILE, "a", encoding="utf-8") as partial, \
+            ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as ex:
+        for product, details in zip(todo, ex.map(extract_product_detail, [p["url"] for p in todo])):
+            if details is None:
+                continue
+
+            product["description"] = details.get("description", "")
+            product["images"] = details.get("images", [])          # ✅ 存檔名 list
+            product["specifications"] = details.get("specifications", "")
+            append_partial(partial, product["url"], src_mtime, {
+                "description": product["description"],
+                "images": product["images"],
+                "specifications": product["specifications"],
+            })
+
+            updated_count += 1
+
+    # 完整的 data.json 只在最後寫一次
+    write_json(DATA_FILE, data)
+    os.remove(PARTIAL_FILE)
 
     print(f"\n{'='*60}")
     print(f"✅ 完成！共更新了 {updated_count} 個商品的資料")
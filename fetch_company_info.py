@@ -1,31 +1,77 @@
 import requests
-from bs4 import BeautifulSoup
-import json
-import re
-import time
+import lxml.html
+from lxml import etree
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
+from crawl_utils import mount_retry_adapter, read_json, response_encoding, write_json
+
 BASE_URL = "http://www.optimumopt.com/"
 DATA_PATH = "crawled_data/data.json"
 
-S = requests.Session()
+S = mount_retry_adapter(requests.Session())
 S.headers.update({
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
                   "(KHTML, like Gecko) Chrome/120.0 Safari/537.36"
 })
 
 
-def get_soup(url: str) -> BeautifulSoup | None:
-    for attempt in range(3):
-        try:
-            r = S.get(url, timeout=20)
-            r.raise_for_status()
-            r.encoding = r.apparent_encoding or "utf-8"
-            return BeautifulSoup(r.text, "lxml")
-        except Exception as e:
-            print(f"❌ 無法抓取 {url} (attempt {attempt+1}/3): {e}")
-            time.sleep(1.2)
-    return None
+def _has_class(name: str) -> str:
+    """XPath 條件：class 屬性裡有這個 token（等同 BS 的 class_= 比對）"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# 主內容區候選（依序，先找到先用）
+_MAIN_CONTENT_XPS = tuple(
+    etree.XPath(f"(//div[{cond}])[1]")
+    for cond in (
+        '@id="block-body"',
+        _has_class("block-body"),
+        _has_class("site-widget-bd"),
+        _has_class("edit-wrap-content"),
+        _has_class("content"),
+        '@id="main_content"',
+    )
+)
+_BODY_XP = etree.XPath("(//body)[1]")
+# 常見雜訊區塊
+_NOISE_XP = etree.XPath(
+    "descendant::script | descendant::style | descendant::noscript"
+    " | descendant::header | descendant::footer | descendant::nav | descendant::aside"
+)
+_TEXT_XP = etree.XPath(".//text()")
+
+# 新聞容器候選（依序，先找到非空的就用）
+_NEWS_BLOCK_XPS = tuple(
+    etree.XPath(x)
+    for x in (
+        f"//div[{_has_class('article-item')}]",
+        f"//div[{_has_class('news-item')}]",
+        f"//li[{_has_class('news')}]",
+        "//article",
+    )
+)
+_ANCHOR_XP = etree.XPath("//a[@href]")
+_NEWS_TITLE_XP = etree.XPath("(.//*[self::h2 or self::h3 or self::h4 or self::a])[1]")
+_NEWS_DATE_XP = etree.XPath(
+    f"(.//*[{_has_class('date')} or {_has_class('time')} or {_has_class('publish-time')}])[1]"
+)
+_NEWS_SUMMARY_XP = etree.XPath(
+    f"(.//*[(self::p or self::div) and ({_has_class('summary')} or {_has_class('excerpt')} or {_has_class('content')})])[1]"
+)
+_NEWS_LINK_XP = etree.XPath("(.//a[@href])[1]")
+
+
+def get_root(url: str) -> lxml.html.HtmlElement | None:
+    # 重試交給 S 的 adapter
+    try:
+        r = S.get(url, timeout=20)
+        r.raise_for_status()
+        # 直接餵 bytes 給 lxml，用判斷出的編碼解
+        return lxml.html.document_fromstring(r.content, parser=lxml.html.HTMLParser(encoding=response_encoding(r)))
+    except Exception as e:
+        print(f"❌ 無法抓取 {url}: {e}")
+        return None
 
 
 def clean_lines(text: str) -> str:
@@ -37,64 +83,59 @@ def clean_lines(text: str) -> str:
     return "\n".join(lines)
 
 
-def extract_main_content(soup: BeautifulSoup | None) -> str:
-    if not soup:
-        return ""
+def _node_text(node, sep: str = "") -> str:
+    """同 BS 的 get_text(sep, strip=True)"""
+    return sep.join(t for t in (s.strip() for s in _TEXT_XP(node)) if t)
 
-    # 優先找可能的主內容區
-    selectors = [
-        ("div", {"id": "block-body"}),
-        ("div", {"class": "block-body"}),
-        ("div", {"class": "site-widget-bd"}),
-        ("div", {"class": "edit-wrap-content"}),
-        ("div", {"class": "content"}),
-        ("div", {"id": "main_content"}),
-    ]
+
+def _first(xp, node):
+    found = xp(node)
+    return found[0] if found else None
+
+
+def extract_main_content(root: lxml.html.HtmlElement | None) -> str:
+    if root is None:
+        return ""
 
     def strip_noise(node):
-        for tag in node.find_all(["script", "style", "noscript"]):
-            tag.decompose()
-        # 常見雜訊區塊
-        for sel in ["header", "footer", "nav", "aside"]:
-            for tag in node.find_all(sel):
-                tag.decompose()
-
-    for tag_name, attrs in selectors:
-        content_div = soup.find(tag_name, attrs)
-        if content_div:
+        # 清空而不摘除：後面的 tail 文字仍是獨立的一段（跟 BS decompose 一樣）
+        for tag in _NOISE_XP(node):
+            tag.clear(keep_tail=True)
+
+    # 優先找可能的主內容區
+    for xp in _MAIN_CONTENT_XPS:
+        content_div = _first(xp, root)
+        if content_div is not None:
             strip_noise(content_div)
-            text = content_div.get_text("\n", strip=True)
-            return clean_lines(text)
+            return clean_lines(_node_text(content_div, "\n"))
 
     # fallback: body
-    body = soup.find("body")
-    if body:
+    body = _first(_BODY_XP, root)
+    if body is not None:
         strip_noise(body)
-        text = body.get_text("\n", strip=True)
-        return clean_lines(text)
+        return clean_lines(_node_text(body, "\n"))
 
     return ""
 
 
-def extract_news_items(soup: BeautifulSoup | None, page_url: str) -> list[dict]:
-    if not soup:
+def extract_news_items(root: lxml.html.HtmlElement | None, page_url: str) -> list[dict]:
+    if root is None:
         return []
 
     items = []
 
     # 先找可能的新聞容器
-    candidates = (
-        soup.find_all("div", class_="article-item")
-        or soup.find_all("div", class_="news-item")
-        or soup.find_all("li", class_="news")
-        or soup.find_all("article")
-    )
+    candidates = []
+    for xp in _NEWS_BLOCK_XPS:
+        candidates = xp(root)
+        if candidates:
+            break
 
     # 若找不到，退而求其次：抓所有疑似新聞連結
     if not candidates:
-        for a in soup.find_all("a", href=True):
-            txt = a.get_text(strip=True)
-            href = a["href"]
+        for a in _ANCHOR_XP(root):
+            txt = _node_text(a)
+            href = a.get("href")
             if not txt or len(txt) < 4:
                 continue
             # 簡單判斷：新聞頁常見參數
@@ -114,18 +155,18 @@ def extract_news_items(soup: BeautifulSoup | None, page_url: str) -> list[dict]:
         return uniq[:10]
 
     for block in candidates[:10]:
-        title_tag = block.find(["h2", "h3", "h4", "a"])
-        date_tag = block.find(class_=["date", "time", "publish-time"])
-        content_tag = block.find(["p", "div"], class_=["summary", "excerpt", "content"])
-        link_tag = block.find("a", href=True)
+        title_tag = _first(_NEWS_TITLE_XP, block)
+        date_tag = _first(_NEWS_DATE_XP, block)
+        content_tag = _first(_NEWS_SUMMARY_XP, block)
+        link_tag = _first(_NEWS_LINK_XP, block)
 
-        title = title_tag.get_text(strip=True) if title_tag else ""
-        date = date_tag.get_text(strip=True) if date_tag else ""
-        summary = content_tag.get_text(strip=True) if content_tag else ""
+        title = _node_text(title_tag) if title_tag is not None else ""
+        date = _node_text(date_tag) if date_tag is not None else ""
+        summary = _node_text(content_tag) if content_tag is not None else ""
 
         url = ""
-        if link_tag:
-            url = urljoin(BASE_URL, link_tag["href"])
+        if link_tag is not None:
+            url = urljoin(BASE_URL, link_tag.get("href"))
 
         if title:
             items.append({
@@ -164,14 +205,16 @@ def fetch_company_info() -> dict:
     print("開始抓取公司資訊...")
     print("=" * 60)
 
-    for key, page in company_pages.items():
+    # 幾個頁面同時抓，解析仍依原順序
+    with ThreadPoolExecutor(max_workers=len(company_pages)) as ex:
+        roots = list(ex.map(get_root, [page["url"] for page in company_pages.values()]))
+
+    for (key, page), root in zip(company_pages.items(), roots):
         print(f"\n📄 正在抓取: {page['name']}")
         print(f"   URL: {page['url']}")
 
-        soup = get_soup(page["url"])
-
         if key == "news":
-            news_items = extract_news_items(soup, page["url"])
+            news_items = extract_news_items(root, page["url"])
             if news_items:
                 out[key] = {
                     "url": page["url"],
@@ -180,11 +223,11 @@ def fetch_company_info() -> dict:
                 }
                 print(f"   ✅ 成功抓取 {len(news_items)} 則新聞（列表）")
             else:
-                content = extract_main_content(soup)
+                content = extract_main_content(root)
                 out[key] = {"url": page["url"], "content": content}
                 print(f"   ✅ 以全文方式抓取（{len(content)} 字元）")
         else:
-            content = extract_main_content(soup)
+            content = extract_main_content(root)
             out[key] = {"url": page["url"], "content": content}
             print(f"   ✅ 成功抓取內容（{len(content)} 字元）")
 
@@ -193,8 +236,7 @@ def fetch_company_info() -> dict:
 
 def update_data_json(company_info: dict):
     try:
-        with open(DATA_PATH, "r", encoding="utf-8") as f:
-            data = json.load(f)
+        data = read_json(DATA_PATH)
     except FileNotFoundError:
         print(f"❌ 找不到 {DATA_PATH}")
         return
@@ -202,8 +244,7 @@ def update_data_json(company_info: dict):
     # ✅ 只更新 company_info，不動 products
     data["company_info"] = company_info
 
-    with open(DATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    write_json(DATA_PATH, data)
 
     print("\n" + "=" * 60)
     print(f"✅ 公司資訊已更新至 {DATA_PATH}")
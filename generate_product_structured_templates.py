@@ -7,10 +7,12 @@ OUTPUT_DIR = "data/product_structured"
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+_UNSAFE_CHARS_RE = re.compile(r"[\\/:*?\"<>|]")
+
 
 def safe_filename(name: str) -> str:
     name = name.strip()
-    name = re.sub(r"[\\/:*?\"<>|]", "_", name)
+    name = _UNSAFE_CHARS_RE.sub("_", name)
     return name
 
 
@@ -47,12 +49,17 @@ def main():
 
     created = 0
 
+    # 一次列出既有模板，不用每個產品各 stat 一次
+    with os.scandir(OUTPUT_DIR) as it:
+        existing = {e.name for e in it if e.is_file()}
+
     for title, category in rows:
         fname = safe_filename(title) + ".txt"
         path = os.path.join(OUTPUT_DIR, fname)
 
-        if os.path.exists(path):
+        if fname in existing:
             continue  # 已存在就不覆蓋（避免你填過的被洗掉）
+        existing.add(fname)  # 不同標題可能轉成同一個檔名，先到先寫
 
         content = TEMPLATE.format(
             title=title.strip(),
@@ -3,14 +3,24 @@ import re
 import json
 import csv
 import hashlib
+import mmap
 import sqlite3
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, List, Optional, Set, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import requests
 
+from crawl_utils import copy_capped, mount_retry_adapter
+
+try:
+    import orjson
+except ImportError:  # orjson 為選配：沒裝就退回標準 json
+    orjson = None
+
 logger = logging.getLogger("image-cache")
 
 # -----------------------------
@@ -18,6 +28,8 @@ logger = logging.getLogger("image-cache")
 # -----------------------------
 IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "crawled_data/images")
 IMAGE_DOWNLOAD_TIMEOUT = int(os.getenv("IMAGE_DOWNLOAD_TIMEOUT", "15"))
+# 批次下載時同時進行的連線數
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv("IMAGE_DOWNLOAD_WORKERS", "16"))
 IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))  # 15MB
 IMAGE_USER_AGENT = os.getenv(
     "IMAGE_USER_AGENT",
@@ -28,11 +40,33 @@ IMAGE_USER_AGENT = os.getenv(
 KEEP_ORIGINAL_URL_ON_FAIL = os.getenv("KEEP_ORIGINAL_URL_ON_FAIL", "0") == "1"
 # 已成功快取過就跳過（預設開啟）
 SKIP_ALREADY_CACHED_OK = os.getenv("SKIP_ALREADY_CACHED_OK", "1") == "1"
+# 已快取的圖改用 ETag/Last-Modified 條件式請求重新驗證（304 不傳 body；預設關閉）
+IMAGE_REVALIDATE = os.getenv("IMAGE_REVALIDATE", "0") == "1"
+
+
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": IMAGE_USER_AGENT})
+# keep-alive 連線池 + 指數退避重試；pool 大小要蓋過 IMAGE_DOWNLOAD_WORKERS
+mount_retry_adapter(SESSION, pool_maxsize=max(64, IMAGE_DOWNLOAD_WORKERS))
 
 
 # -----------------------------
 # Utilities
 # -----------------------------
+_IMG_EXTS = frozenset({".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff"})
+_CT_TO_EXT = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+    "image/gif": ".gif",
+    "image/bmp": ".bmp",
+    "image/tiff": ".tif",
+}
+# bytes 版：直接在 mmap 上掃，不用先把整個檔案 decode 成 str（檔名只會是 ASCII）
+_MD_IMAGE_REF_RE = re.compile(rb'([a-zA-Z0-9_\-./]+?\.(?:png|jpg|jpeg|webp|gif|bmp|tif|tiff))', re.IGNORECASE)
+
+
 def _ensure_dir(p: str) -> None:
     os.makedirs(p, exist_ok=True)
 
@@ -41,16 +75,69 @@ def is_http_url(s: str) -> bool:
     return isinstance(s, str) and (s.startswith("http://") or s.startswith("https://"))
 
 
+def _file_size(path: str) -> int:
+    """一次 stat 同時判斷存在與大小；不存在回 0"""
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return 0
+
+
 def _sha1(s: str) -> str:
     return hashlib.sha1(s.encode("utf-8")).hexdigest()
 
 
+def _urlkey(s: str) -> str:
+    return hashlib.blake2b(s.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _cache_filename(url: str, ext: str) -> str:
+    """
+    新檔名用 blake2b；舊版以 sha1 命名、已在磁碟上的檔案沿用原名
+    （products.images 直接存檔名，改名會讓既有引用失效，所以不 rename）
+    """
+    legacy = _sha1(url) + ext
+    if _file_size(os.path.join(IMAGE_CACHE_DIR, legacy)) > 0:
+        return legacy
+    return _urlkey(url) + ext
+
+
+def _open_tmp_exclusive(tmp_path: str):
+    """
+    O_EXCL 建立 .tmp：同一張圖只有一個下載者（別的 process 也一樣）。
+    已被別人建立就回 None；超過兩倍下載逾時還在的 .tmp 視為上次中斷留下的，清掉重搶一次。
+    """
+    for _ in range(2):
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            return os.fdopen(fd, "wb")
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(tmp_path).st_mtime <= IMAGE_DOWNLOAD_TIMEOUT * 2:
+                    return None
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass  # 剛好被對方 replace 掉，再搶一次
+    return None
+
+
+def _wait_for_file(path: str, timeout: float) -> int:
+    """等別的下載者把檔案 replace 到位；回傳大小（逾時回 0）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        size = _file_size(path)
+        if size > 0:
+            return size
+        time.sleep(0.2)
+    return _file_size(path)
+
+
 def _guess_ext_from_url(url: str) -> str:
     try:
         path = url.split("?", 1)[0].split("#", 1)[0]
         _, ext = os.path.splitext(path)
         ext = (ext or "").lower()
-        if ext in [".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff"]:
+        if ext in _IMG_EXTS:
             return ext
     except Exception:
         pass
@@ -59,16 +146,7 @@ def _guess_ext_from_url(url: str) -> str:
 
 def _guess_ext_from_content_type(ct: str) -> str:
     ct = (ct or "").lower().split(";")[0].strip()
-    mapping = {
-        "image/jpeg": ".jpg",
-        "image/jpg": ".jpg",
-        "image/png": ".png",
-        "image/webp": ".webp",
-        "image/gif": ".gif",
-        "image/bmp": ".bmp",
-        "image/tiff": ".tif",
-    }
-    return mapping.get(ct, "")
+    return _CT_TO_EXT.get(ct, "")
 
 
 def _safe_json_list(v: Any) -> List[str]:
@@ -96,6 +174,13 @@ def _safe_json_list(v: Any) -> List[str]:
     return []
 
 
+def _dumps_list(items: List[str]) -> str:
+    """寫回 products.images 的 JSON 字串（SQLite 存 TEXT）"""
+    if orjson is not None:
+        return orjson.dumps(items).decode("utf-8")
+    return json.dumps(items, ensure_ascii=False)
+
+
 def _normalize_local_filename(s: str) -> str:
     if not isinstance(s, str):
         return ""
@@ -115,28 +200,56 @@ def _now_iso() -> str:
 # -----------------------------
 # SQLite image_cache table
 # -----------------------------
+_IMAGE_CACHE_COLUMNS = """
+    url TEXT PRIMARY KEY,
+    filename TEXT,
+    status TEXT,           -- ok / failed
+    http_status INTEGER,
+    content_type TEXT,
+    size_bytes INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    error TEXT,
+    updated_at TEXT
+"""
+
+
 def ensure_image_cache_table(conn: sqlite3.Connection) -> None:
-    conn.execute(
-        """
-        CREATE TABLE IF NOT EXISTS image_cache (
-            url TEXT PRIMARY KEY,
-            filename TEXT,
-            status TEXT,           -- ok / failed
-            http_status INTEGER,
-            content_type TEXT,
-            size_bytes INTEGER,
-            etag TEXT,
-            last_modified TEXT,
-            error TEXT,
-            updated_at TEXT
-        )
-        """
-    )
+    """
+    WITHOUT ROWID：整列直接存在 url 主鍵的 B-tree 裡，WHERE url=? 只走一棵樹。
+    舊版（有 rowid）的表會搬一次資料過來。
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='image_cache'").fetchone()
+    if row and "WITHOUT ROWID" in (row[0] or "").upper():
+        return
+
+    if row:
+        conn.execute("ALTER TABLE image_cache RENAME TO image_cache_old")
+    conn.execute(f"CREATE TABLE image_cache ({_IMAGE_CACHE_COLUMNS}) WITHOUT ROWID")
+    if row:
+        conn.execute("INSERT OR REPLACE INTO image_cache SELECT url, filename, status, http_status, content_type, "
+                     "size_bytes, etag, last_modified, error, updated_at FROM image_cache_old WHERE url IS NOT NULL")
+        conn.execute("DROP TABLE image_cache_old")
     conn.commit()
 
 
-def upsert_cache_row(
-    conn: sqlite3.Connection,
+_UPSERT_CACHE_SQL = """
+    INSERT INTO image_cache(url, filename, status, http_status, content_type, size_bytes, etag, last_modified, error, updated_at)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(url) DO UPDATE SET
+        filename=excluded.filename,
+        status=excluded.status,
+        http_status=excluded.http_status,
+        content_type=excluded.content_type,
+        size_bytes=excluded.size_bytes,
+        etag=excluded.etag,
+        last_modified=excluded.last_modified,
+        error=excluded.error,
+        updated_at=excluded.updated_at
+"""
+
+
+def _cache_row_params(
     url: str,
     filename: Optional[str],
     status: str,
@@ -146,36 +259,19 @@ def upsert_cache_row(
     etag: Optional[str],
     last_modified: Optional[str],
     error: Optional[str],
-) -> None:
-    conn.execute(
-        """
-        INSERT INTO image_cache(url, filename, status, http_status, content_type, size_bytes, etag, last_modified, error, updated_at)
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(url) DO UPDATE SET
-            filename=excluded.filename,
-            status=excluded.status,
-            http_status=excluded.http_status,
-            content_type=excluded.content_type,
-            size_bytes=excluded.size_bytes,
-            etag=excluded.etag,
-            last_modified=excluded.last_modified,
-            error=excluded.error,
-            updated_at=excluded.updated_at
-        """,
-        (
-            url,
-            filename or "",
-            status,
-            int(http_status) if http_status is not None else None,
-            content_type or "",
-            int(size_bytes) if size_bytes is not None else None,
-            etag or "",
-            last_modified or "",
-            (error or "")[:500],
-            _now_iso(),
-        ),
+) -> tuple:
+    return (
+        url,
+        filename or "",
+        status,
+        int(http_status) if http_status is not None else None,
+        content_type or "",
+        int(size_bytes) if size_bytes is not None else None,
+        etag or "",
+        last_modified or "",
+        (error or "")[:500],
+        _now_iso(),
     )
-    conn.commit()
 
 
 def get_cached_filename_if_ok(conn: sqlite3.Connection, url: str) -> Optional[str]:
@@ -185,8 +281,7 @@ def get_cached_filename_if_ok(conn: sqlite3.Connection, url: str) -> Optional[st
         return None
     filename, status = (row[0] or "").strip(), row[1]
     if status == "ok" and filename:
-        fpath = os.path.join(IMAGE_CACHE_DIR, filename)
-        if os.path.exists(fpath) and os.path.getsize(fpath) > 0:
+        if _file_size(os.path.join(IMAGE_CACHE_DIR, filename)) > 0:
             return filename
     return None
 
@@ -194,94 +289,196 @@ def get_cached_filename_if_ok(conn: sqlite3.Connection, url: str) -> Optional[st
 # -----------------------------
 # Core downloader
 # -----------------------------
-def download_image_if_url(conn: sqlite3.Connection, url: str) -> Optional[str]:
-    """
-    - 若 url 不是 http(s)，視為本機檔名 → normalize 後回傳
-    - 若是 http(s)，會：
-        * 查 image_cache (ok) → 直接回傳 filename
-        * 否則下載到 crawled_data/images/<sha1>.<ext>
-        * 成功寫入 image_cache
-    """
-    url = (url or "").strip()
-    if not is_http_url(url):
-        return _normalize_local_filename(url) or None
+@dataclass
+class FetchResult:
+    url: str
+    filename: Optional[str] = None
+    status: str = "failed"
+    http_status: Optional[int] = None
+    content_type: Optional[str] = None
+    size_bytes: Optional[int] = None
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    error: Optional[str] = None
+
+
+def _fetch_row_params(res: FetchResult) -> tuple:
+    return _cache_row_params(
+        res.url, res.filename, res.status, res.http_status, res.content_type,
+        res.size_bytes, res.etag, res.last_modified, res.error,
+    )
 
-    _ensure_dir(IMAGE_CACHE_DIR)
-    ensure_image_cache_table(conn)
 
-    if SKIP_ALREADY_CACHED_OK:
-        cached = get_cached_filename_if_ok(conn, url)
-        if cached:
-            return cached
+def _get_revalidation_row(conn: sqlite3.Connection, url: str) -> Optional[sqlite3.Row]:
+    """IMAGE_REVALIDATE 時：已快取且有 ETag/Last-Modified 的列才需要條件式請求"""
+    cur = conn.execute(
+        "SELECT filename, content_type, etag, last_modified FROM image_cache WHERE url = ?", (url,)
+    )
+    cur.row_factory = sqlite3.Row
+    row = cur.fetchone()
+    if row and (row["etag"] or row["last_modified"]):
+        return row
+    return None
+
 
-    base = _sha1(url)
+def _fetch_image(url: str, cached: Optional[sqlite3.Row] = None) -> FetchResult:
+    """
+    只做網路 + 檔案（不碰 SQLite），可以丟到 thread pool 並行跑；
+    結果由呼叫端寫回 image_cache。
+    cached：重新驗證用的 image_cache 列（帶 If-None-Match / If-Modified-Since）
+    """
     ext = _guess_ext_from_url(url)
-    filename = base + (ext if ext else "")
+    tmp_path = None
 
-    headers = {"User-Agent": IMAGE_USER_AGENT}
+    headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        if cached["last_modified"]:
+            headers["If-Modified-Since"] = cached["last_modified"]
 
     try:
-        with requests.get(url, headers=headers, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as resp:
+        with SESSION.get(url, headers=headers, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as resp:
             http_status = resp.status_code
+            if http_status == 304 and cached is not None:
+                # 伺服器確認未變更：沿用本機檔，不讀 body
+                return FetchResult(
+                    url, cached["filename"], "ok", http_status, cached["content_type"],
+                    _file_size(os.path.join(IMAGE_CACHE_DIR, cached["filename"])),
+                    resp.headers.get("ETag") or cached["etag"],
+                    resp.headers.get("Last-Modified") or cached["last_modified"],
+                    "",
+                )
             if http_status != 200:
-                upsert_cache_row(
-                    conn, url, None, "failed", http_status, None, None,
+                return FetchResult(
+                    url, None, "failed", http_status, None, None,
                     resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
-                    f"HTTP {http_status}"
+                    f"HTTP {http_status}",
                 )
-                return None
 
             content_type = resp.headers.get("Content-Type", "")
             if not ext:
                 ext = _guess_ext_from_content_type(content_type) or ".jpg"
-                filename = base + ext
+            filename = _cache_filename(url, ext)
 
-            tmp_path = os.path.join(IMAGE_CACHE_DIR, filename + ".tmp")
             final_path = os.path.join(IMAGE_CACHE_DIR, filename)
 
-            # 已存在就直接記錄 ok 並回傳
-            if os.path.exists(final_path) and os.path.getsize(final_path) > 0:
-                upsert_cache_row(
-                    conn, url, filename, "ok", http_status, content_type, os.path.getsize(final_path),
+            # 已存在就直接記錄 ok 並回傳（重新驗證拿到 200 代表內容變了，要覆蓋）
+            existing_size = _file_size(final_path) if cached is None else 0
+            if existing_size > 0:
+                return FetchResult(
+                    url, filename, "ok", http_status, content_type, existing_size,
                     resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
-                    ""
+                    "",
                 )
-                return filename
 
-            size = 0
-            with open(tmp_path, "wb") as f:
-                for chunk in resp.iter_content(chunk_size=64 * 1024):
-                    if not chunk:
-                        continue
-                    size += len(chunk)
-                    if size > IMAGE_MAX_BYTES:
-                        raise ValueError(f"Image too large: > {IMAGE_MAX_BYTES} bytes")
-                    f.write(chunk)
+            f = _open_tmp_exclusive(final_path + ".tmp")
+            if f is None:
+                # 別人正在下載同一張：等它寫完直接沿用，不重複下載
+                size = _wait_for_file(final_path, IMAGE_DOWNLOAD_TIMEOUT)
+                if size <= 0:
+                    raise ValueError("Concurrent download did not finish")
+                return FetchResult(
+                    url, filename, "ok", http_status, content_type, size,
+                    resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
+                    "",
+                )
+
+            tmp_path = final_path + ".tmp"  # 從這裡開始 .tmp 是自己的，失敗時才能刪
+            resp.raw.decode_content = True  # 跟 iter_content 一樣解開 gzip/deflate
+            with f:
+                size = copy_capped(resp.raw, f, IMAGE_MAX_BYTES)
 
             if size <= 0:
                 raise ValueError("Downloaded empty file")
 
             os.replace(tmp_path, final_path)
 
-            upsert_cache_row(
-                conn, url, filename, "ok", http_status, content_type, size,
+            return FetchResult(
+                url, filename, "ok", http_status, content_type, size,
                 resp.headers.get("ETag"), resp.headers.get("Last-Modified"),
-                ""
+                "",
             )
-            return filename
 
     except Exception as e:
         # 清掉殘留 tmp
         try:
-            tmp_path = os.path.join(IMAGE_CACHE_DIR, base + (ext if ext else "") + ".tmp")
-            if os.path.exists(tmp_path):
+            if tmp_path and os.path.exists(tmp_path):
                 os.remove(tmp_path)
         except Exception:
             pass
 
-        upsert_cache_row(conn, url, None, "failed", None, None, None, None, None, str(e))
         logger.warning(f"download failed: {url} err={e}")
-        return None
+        return FetchResult(url, None, "failed", None, None, None, None, None, str(e))
+
+
+def download_image_if_url(conn: sqlite3.Connection, url: str) -> Optional[str]:
+    """
+    - 若 url 不是 http(s)，視為本機檔名 → normalize 後回傳
+    - 若是 http(s)，會：
+        * 查 image_cache (ok) → 直接回傳 filename
+        * 否則下載到 crawled_data/images/<blake2b>.<ext>（舊的 <sha1>.<ext> 沿用）
+        * 成功寫入 image_cache
+    """
+    url = (url or "").strip()
+    if not is_http_url(url):
+        return _normalize_local_filename(url) or None
+
+    _ensure_dir(IMAGE_CACHE_DIR)
+    ensure_image_cache_table(conn)
+
+    revalidate = None
+    if SKIP_ALREADY_CACHED_OK:
+        cached = get_cached_filename_if_ok(conn, url)
+        if cached:
+            revalidate = _get_revalidation_row(conn, url) if IMAGE_REVALIDATE else None
+            if revalidate is None:
+                return cached
+
+    res = _fetch_image(url, revalidate)
+    if revalidate is not None and res.status != "ok":
+        return revalidate["filename"]  # 驗證失敗（網路/站台問題）就先沿用本機檔
+    conn.execute(_UPSERT_CACHE_SQL, _fetch_row_params(res))
+    conn.commit()
+    return res.filename
+
+
+def download_images_if_urls(conn: sqlite3.Connection, urls: List[str]) -> Dict[str, Optional[str]]:
+    """
+    批次版 download_image_if_url：回傳 {url: filename or None}
+    - 先查 image_cache（主 thread）；IMAGE_REVALIDATE 時已快取的也送條件式請求
+    - 沒快取的用 IMAGE_DOWNLOAD_WORKERS 個 thread 並行下載
+    - 結果回到主 thread 再用一次 executemany 寫 image_cache（sqlite3 連線不跨 thread）
+    - 不 commit：由呼叫端決定交易範圍
+    """
+    _ensure_dir(IMAGE_CACHE_DIR)
+    ensure_image_cache_table(conn)
+
+    out: Dict[str, Optional[str]] = {}
+    todo: List[str] = []
+    revalidate: List[Optional[sqlite3.Row]] = []
+    for url in dict.fromkeys(u.strip() for u in urls if is_http_url((u or "").strip())):
+        cached = get_cached_filename_if_ok(conn, url) if SKIP_ALREADY_CACHED_OK else None
+        if cached:
+            out[url] = cached
+            row = _get_revalidation_row(conn, url) if IMAGE_REVALIDATE else None
+            if row is None:
+                continue
+        else:
+            row = None
+        todo.append(url)
+        revalidate.append(row)
+
+    if todo:
+        with ThreadPoolExecutor(max_workers=IMAGE_DOWNLOAD_WORKERS) as ex:
+            results = list(ex.map(_fetch_image, todo, revalidate))
+        # 驗證失敗（網路/站台問題）就先沿用 out 裡的本機檔，不覆寫快取列
+        results = [res for res, row in zip(results, revalidate) if row is None or res.status == "ok"]
+        conn.executemany(_UPSERT_CACHE_SQL, [_fetch_row_params(res) for res in results])
+        for res in results:
+            out[res.url] = res.filename
+
+    return out
 
 
 # -----------------------------
@@ -298,6 +495,31 @@ class CacheRunStats:
     finished_at: str = ""
 
 
+# Python str.strip() 會去掉的所有空白字元（SQLite trim 預設只去半形空白）
+# 即 "".join(c for c in map(chr, range(0x110000)) if c.isspace())；寫死避免 import 時掃 110 萬個字元
+_WHITESPACE_CHARS = (
+    "\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0\u1680"
+    "\u2000\u2001\u2002\u2003\u2004\u2005\u2006\u2007\u2008\u2009\u200a"
+    "\u2028\u2029\u202f\u205f\u3000"
+)
+
+
+def _clean_images_sql(col_images: str) -> str:
+    """
+    SQL 條件：images 是 JSON list，且每個元素都已是 _normalize_local_filename 後的本機檔名
+    （非空字串、前後無空白、不是 http(s)、沒有反斜線 / crawled_data/images/ / 開頭斜線）。
+    這種列在下面的迴圈裡 changed 一定是 False。需要一個參數：_WHITESPACE_CHARS。
+    """
+    return (
+        f"(CASE WHEN json_valid({col_images}) THEN json_type({col_images}) END IS 'array' "
+        f"AND NOT EXISTS (SELECT 1 FROM json_each({col_images}) je WHERE "
+        "je.type != 'text' OR je.value = '' OR je.value != trim(je.value, ?1) "
+        "OR je.value LIKE 'http://%' OR je.value LIKE 'https://%' "
+        "OR instr(je.value, char(92)) > 0 OR instr(je.value, 'crawled_data/images/') > 0 "
+        "OR substr(je.value, 1, 1) = '/'))"
+    )
+
+
 def cache_product_images_in_db(
     db_path: str,
     products_table: str = "products",
@@ -325,17 +547,35 @@ def cache_product_images_in_db(
     try:
         with sqlite3.connect(db_path, timeout=30) as conn:
             conn.row_factory = sqlite3.Row
+            # 整批只 commit 一次；WAL + NORMAL 讓那次 commit 便宜、也不擋 app 讀取
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size=268435456")  # 256MB：讀取直接走記憶體映射
             ensure_image_cache_table(conn)
 
+            stats.total_rows = conn.execute(f"SELECT COUNT(*) FROM {products_table}").fetchone()[0]
+
             # ✅ 不用 rowid，直接用 id（修正你遇到的 No item with that key）
-            cur = conn.execute(f"SELECT {col_id} as pid, {col_images} as images FROM {products_table}")
+            # 已經是乾淨本機檔名 JSON list 的列不會有任何變動，直接在 SQL 排除（重跑時多半全是這種）
+            try:
+                cur = conn.execute(
+                    f"SELECT {col_id} as pid, {col_images} as images FROM {products_table} "
+                    f"WHERE NOT {_clean_images_sql(col_images)}",
+                    (_WHITESPACE_CHARS,),
+                )
+            except sqlite3.OperationalError:
+                # 沒有 JSON1：全部交給 Python 判斷
+                cur = conn.execute(f"SELECT {col_id} as pid, {col_images} as images FROM {products_table}")
             rows = cur.fetchall()
-            stats.total_rows = len(rows)
 
-            for r in rows:
-                pid = r["pid"]
-                images_raw = r["images"]
-                images_list = _safe_json_list(images_raw)
+            # 先收齊所有列的 URL，一次並行下載（同一 URL 只抓一次）
+            parsed = [(r["pid"], r["images"], _safe_json_list(r["images"])) for r in rows]
+            url_to_fname = download_images_if_urls(
+                conn, [it for _, _, images_list in parsed for it in images_list]
+            )
+
+            updates: List[Tuple[str, Any]] = []
+            for pid, images_raw, images_list in parsed:
 
                 new_list: List[str] = []
                 changed = False
@@ -347,7 +587,7 @@ def cache_product_images_in_db(
                         continue
 
                     if is_http_url(s):
-                        fname = download_image_if_url(conn, s)
+                        fname = url_to_fname.get(s)
                         if fname:
                             new_list.append(fname)
                             stats.downloaded_ok += 1
@@ -375,12 +615,13 @@ def cache_product_images_in_db(
                             changed = True
 
                 if changed:
-                    conn.execute(
-                        f"UPDATE {products_table} SET {col_images}=? WHERE {col_id}=?",
-                        (json.dumps(new_list, ensure_ascii=False), pid),
-                    )
-                    stats.updated_rows += 1
+                    updates.append((_dumps_list(new_list), pid))
 
+            conn.executemany(
+                f"UPDATE {products_table} SET {col_images}=? WHERE {col_id}=?",
+                updates,
+            )
+            stats.updated_rows = len(updates)
             conn.commit()
 
         stats.finished_at = _now_iso()
@@ -400,40 +641,72 @@ def collect_referenced_filenames_from_db(
     col_images: str = "images",
 ) -> Set[str]:
     refs: Set[str] = set()
+
+    def add(it: Any) -> None:
+        if isinstance(it, str):
+            s = _normalize_local_filename(it.strip())
+            if s and not is_http_url(s):
+                refs.add(s)
+
+    is_array = f"(CASE WHEN json_valid({col_images}) THEN json_type({col_images}) END IS 'array')"
     with sqlite3.connect(db_path, timeout=30) as conn:
-        conn.row_factory = sqlite3.Row
-        cur = conn.execute(f"SELECT {col_images} as images FROM {products_table}")
-        for r in cur.fetchall():
-            imgs = _safe_json_list(r["images"])
-            for it in imgs:
-                if isinstance(it, str):
-                    s = _normalize_local_filename(it.strip())
+        try:
+            # JSON list 直接由 SQLite（JSON1）展開成一列一個檔名，不必逐列 json.loads
+            for (it,) in conn.execute(
+                f"SELECT je.value FROM {products_table}, json_each({products_table}.{col_images}) je "
+                f"WHERE {is_array}"
+            ):
+                add(it)
+            rest_sql = f"SELECT {col_images} FROM {products_table} WHERE NOT {is_array}"
+        except sqlite3.OperationalError:
+            # 沒有 JSON1：全部走 Python
+            rest_sql = f"SELECT {col_images} FROM {products_table}"
+
+        # 少數非 JSON list 的舊資料（單一檔名/網址字串）
+        for (raw,) in conn.execute(rest_sql):
+            for it in _safe_json_list(raw):
+                add(it)
+    return refs
+
+
+def _iter_text_files(d: str):
+    """遞迴列出 .md / .txt（os.scandir 的 DirEntry 自帶類型，不用每個檔再 stat）"""
+    try:
+        it = os.scandir(d)
+    except OSError:
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _iter_text_files(e.path)
+            elif e.name.lower().endswith((".md", ".txt")) and e.is_file():
+                yield e.path
+
+
+def _scan_text_file_refs(path: str) -> Set[str]:
+    refs: Set[str] = set()
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return refs  # 空檔不能 mmap
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for m in _MD_IMAGE_REF_RE.finditer(mm):
+                    s = _normalize_local_filename(m.group(1).decode("ascii"))
                     if s and not is_http_url(s):
                         refs.add(s)
+    except Exception:
+        pass
     return refs
 
 
 def collect_referenced_filenames_from_markdown_dirs(dirs: List[str]) -> Set[str]:
+    paths = [p for d in dirs if d for p in _iter_text_files(d)]
     refs: Set[str] = set()
-    pat = re.compile(r'([a-zA-Z0-9_\-./]+?\.(?:png|jpg|jpeg|webp|gif|bmp|tif|tiff))', re.IGNORECASE)
-
-    for d in dirs:
-        if not d or not os.path.isdir(d):
-            continue
-        for root, _, files in os.walk(d):
-            for fn in files:
-                if not fn.lower().endswith((".md", ".txt")):
-                    continue
-                path = os.path.join(root, fn)
-                try:
-                    with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                        text = f.read()
-                    for m in pat.findall(text):
-                        s = _normalize_local_filename(m)
-                        if s and not is_http_url(s):
-                            refs.add(s)
-                except Exception:
-                    continue
+    if not paths:
+        return refs
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as ex:
+        for found in ex.map(_scan_text_file_refs, paths):
+            refs |= found
     return refs
 
 
@@ -458,14 +731,16 @@ def generate_unused_images_report(
 
     all_files: List[str] = []
     if os.path.isdir(images_dir):
-        for fn in os.listdir(images_dir):
-            if fn.startswith("_gc_report_") or fn.endswith(".tmp"):
-                continue
-            fpath = os.path.join(images_dir, fn)
-            if os.path.isfile(fpath):
-                all_files.append(fn)
+        with os.scandir(images_dir) as it:
+            all_files = [
+                e.name for e in it
+                if not e.name.startswith("_gc_report_")
+                and not e.name.endswith(".tmp")
+                and e.is_file()
+            ]
 
-    unused = sorted([fn for fn in all_files if fn not in referenced])
+    referenced = frozenset(referenced)
+    unused = sorted(set(all_files) - referenced)
 
     payload = {
         "generated_at": _now_iso(),
@@ -486,7 +761,6 @@ def generate_unused_images_report(
     with open(csv_path, "w", encoding="utf-8", newline="") as f:
         w = csv.writer(f)
         w.writerow(["filename"])
-        for fn in unused:
-            w.writerow([fn])
+        w.writerows([fn] for fn in unused)
 
     return json_path, csv_path
@@ -1,20 +1,36 @@
-import sqlite3
 import json
 import os
 import re
 from typing import Any, Dict
 
+try:
+    import orjson
+except ImportError:  # orjson 為選配：沒裝就退回標準 json
+    orjson = None
+
+from db_utils import open_db
+
 
 DATA_PATH = "crawled_data/data.json"
 DB_PATH = "company_data.db"
 
+_WS_RE = re.compile(r"\s+")
+
+# 匯入用的 SQL 固定成常數：同一字串重複使用，sqlite3 的 statement cache 一定命中
+INSERT_PAGE_SQL = "INSERT INTO company_pages (page_type, url, content) VALUES (?, ?, ?)"
+INSERT_NEWS_SQL = "INSERT INTO news (title, url, content, date) VALUES (?, ?, ?, ?)"
+INSERT_PRODUCT_SQL = """
+    INSERT OR IGNORE INTO products (title, url, category, description, specifications, images)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
 
 def clean_text(s: Any) -> str:
     s = (s or "")
     if not isinstance(s, str):
         s = str(s)
     s = s.strip()
-    s = re.sub(r"\s+", " ", s)
+    s = _WS_RE.sub(" ", s)
     return s
 
 
@@ -50,13 +66,8 @@ def normalize_images(images: Any) -> str:
             x = x.split("/")[-1]
         cleaned.append(x)
 
-    seen = set()
-    uniq = []
-    for x in cleaned:
-        if x in seen:
-            continue
-        seen.add(x)
-        uniq.append(x)
+    # dict 保留插入順序：一次完成去重 + 保序
+    uniq = list(dict.fromkeys(cleaned))
 
     return json.dumps(uniq, ensure_ascii=False)
 
@@ -64,6 +75,9 @@ def normalize_images(images: Any) -> str:
 def load_json(path: str) -> Dict:
     if not os.path.exists(path):
         raise FileNotFoundError(f"❌ 找不到資料檔案: {path}")
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
@@ -71,8 +85,11 @@ def load_json(path: str) -> Dict:
 def init_database():
     data = load_json(DATA_PATH)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
+    # 自己下 BEGIN / COMMIT：整個重建 + 匯入是一個交易，不讓 sqlite3 模組在中途隱式開關交易
+    conn.isolation_level = None
     cursor = conn.cursor()
+    cursor.execute("BEGIN")
 
     print("🗑️  刪除舊表格結構...")
     cursor.execute("DROP TABLE IF EXISTS company_pages")
@@ -122,56 +139,48 @@ def init_database():
     # B) 新：company_info = {home:{}, about:{}, contact:{}, news:{}}
     if isinstance(company_info, dict) and ("home" in company_info or "about" in company_info or "contact" in company_info or "news" in company_info):
         # --- 新結構 ---
+        page_rows = []
         for page_type in ["home", "about", "contact"]:
             page = company_info.get(page_type) or {}
             url = clean_text(page.get("url", ""))
             content = clean_text(page.get("content", ""))
-            cursor.execute(
-                "INSERT INTO company_pages (page_type, url, content) VALUES (?, ?, ?)",
-                (page_type, url, content)
-            )
+            page_rows.append((page_type, url, content))
+        cursor.executemany(INSERT_PAGE_SQL, page_rows)
 
         # --- 新聞 ---
         print("📰 匯入新聞資料...")
         news_block = company_info.get("news") or {}
         if isinstance(news_block, dict) and "items" in news_block:
             items = news_block.get("items", []) or []
+            news_rows = []
             for item in items:
                 title = clean_text(item.get("title", ""))
                 url = clean_text(item.get("url", news_block.get("url", "")))
                 content = clean_text(item.get("content", ""))
                 date = clean_text(item.get("date", ""))
                 if title and title != "+更多":
-                    cursor.execute(
-                        "INSERT INTO news (title, url, content, date) VALUES (?, ?, ?, ?)",
-                        (title, url, content, date)
-                    )
+                    news_rows.append((title, url, content, date))
+            cursor.executemany(INSERT_NEWS_SQL, news_rows)
         else:
             # 若 news 只有全文 content（沒 items），就存成一則摘要新聞
             content = clean_text(news_block.get("content", ""))
             url = clean_text(news_block.get("url", ""))
             if content:
-                cursor.execute(
-                    "INSERT INTO news (title, url, content, date) VALUES (?, ?, ?, ?)",
-                    ("新聞頁摘要", url, content, "")
-                )
+                cursor.execute(INSERT_NEWS_SQL, ("新聞頁摘要", url, content, ""))
 
     else:
         # --- 舊結構 fallback ---
         url = clean_text(company_info.get("url", ""))
         content = clean_text(company_info.get("content", ""))
-        cursor.execute(
-            "INSERT INTO company_pages (page_type, url, content) VALUES (?, ?, ?)",
-            ("about", url, content)
-        )
+        cursor.execute(INSERT_PAGE_SQL, ("about", url, content))
         print("📰 匯入新聞資料...（舊 company_info 結構通常沒有 news，略過）")
 
     # ===== 匯入產品 =====
     print("📦 匯入產品資料...")
     products = data.get("products", []) or []
 
-    inserted = 0
     skipped = 0
+    rows = []
 
     for p in products:
         title = clean_text(p.get("title", ""))
@@ -187,27 +196,27 @@ def init_database():
         if not title:
             title = url
 
-        try:
-            cursor.execute(
-                """
-                INSERT INTO products (title, url, category, description, specifications, images)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (title, url, category, description, specifications, images_json)
-            )
-            inserted += 1
-        except sqlite3.IntegrityError:
-            skipped += 1
+        rows.append((title, url, category, description, specifications, images_json))
+
+    # 一次 executemany；重複 url 由 UNIQUE 約束 + OR IGNORE 略過，不必逐筆 try/except
+    changes_before = conn.total_changes
+    cursor.executemany(INSERT_PRODUCT_SQL, rows)
+    inserted = conn.total_changes - changes_before
+    skipped += len(rows) - inserted
+
+    # 分類統計 / 依分類查詢用；資料都進來後才建，比逐筆維護索引快
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)")
 
-    conn.commit()
+    cursor.execute("COMMIT")
 
     # ===== 統計 =====
-    cursor.execute("SELECT COUNT(*) FROM company_pages")
-    pages_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM news")
-    news_count = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM products")
-    products_count = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT
+          (SELECT COUNT(*) FROM company_pages),
+          (SELECT COUNT(*) FROM news),
+          (SELECT COUNT(*) FROM products)
+    """)
+    pages_count, news_count, products_count = cursor.fetchone()
 
     cursor.execute("""
         SELECT
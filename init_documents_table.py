@@ -1,8 +1,8 @@
-import sqlite3
+from db_utils import open_db
 
 DB_PATH = "company_data.db"
 
-with sqlite3.connect(DB_PATH) as conn:
+with open_db(DB_PATH) as conn:
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS documents (
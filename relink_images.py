@@ -4,34 +4,55 @@ import json
 import sqlite3
 import difflib
 
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # 沒裝 rapidfuzz 時退回 difflib（較慢，結果相近）
+    fuzz = process = None
+
+from db_utils import open_db
+
 DB_PATH = "company_data.db"
 IMG_DIR = "crawled_data/images"
 
+_NON_AN_RE = re.compile(r"[^a-z0-9_]+")
+
 
 def normalize(s: str) -> str:
     s = s.lower()
     s = s.replace("-", "_").replace(" ", "_")
-    s = re.sub(r"[^a-z0-9_]+", "", s)
+    s = _NON_AN_RE.sub("", s)
     return s
 
 
+def best_match(key: str, choices: list) -> str | None:
+    """在 choices 裡找與 key 最像的一個（相似度 >= 0.4），找不到回 None"""
+    if process is not None:
+        hit = process.extractOne(key, choices, scorer=fuzz.ratio, score_cutoff=40)
+        return hit[0] if hit else None
+    best = difflib.get_close_matches(key, choices, n=1, cutoff=0.4)
+    return best[0] if best else None
+
+
 def main():
     if not os.path.exists(DB_PATH):
         raise FileNotFoundError(DB_PATH)
     if not os.path.isdir(IMG_DIR):
         raise FileNotFoundError(IMG_DIR)
 
-    images = [f for f in os.listdir(IMG_DIR)
-              if f.lower().endswith((".jpg", ".jpeg", ".png", ".webp"))]
+    # scandir 的 DirEntry 自帶檔案類型，不必另外 stat
+    with os.scandir(IMG_DIR) as it:
+        images = [e.name for e in it
+                  if e.name.lower().endswith((".jpg", ".jpeg", ".png", ".webp")) and e.is_file()]
 
     norm_images = {normalize(f): f for f in images}
+    choices = list(norm_images.keys())
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
     conn.row_factory = sqlite3.Row
 
     rows = conn.execute("SELECT id, title, images FROM products").fetchall()
 
-    updated = 0
+    updates = []
 
     for r in rows:
         pid = r["id"]
@@ -39,24 +60,24 @@ def main():
 
         key = normalize(title)
 
-        best = difflib.get_close_matches(key, norm_images.keys(), n=1, cutoff=0.4)
+        best = best_match(key, choices)
 
         if not best:
             continue
 
-        fname = norm_images[best[0]]
+        fname = norm_images[best]
 
-        conn.execute(
-            "UPDATE products SET images=? WHERE id=?",
-            (json.dumps([fname], ensure_ascii=False), pid)
-        )
+        updates.append((json.dumps([fname], ensure_ascii=False), pid))
 
         print(f"[LINK] {title} -> {fname}")
-        updated += 1
 
-    conn.commit()
+    # 一次 executemany，整批在同一個交易裡
+    with conn:
+        conn.executemany("UPDATE products SET images=? WHERE id=?", updates)
     conn.close()
 
+    updated = len(updates)
+
     print(f"\nDone. Updated rows = {updated}")
 
 
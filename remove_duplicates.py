@@ -1,5 +1,4 @@
-import json
-from urllib.parse import urlparse, urlunparse
+from crawl_utils import read_json, write_json
 
 DATA_PATH = "crawled_data/data.json"
 
@@ -14,26 +13,23 @@ def normalize_url(url: str) -> str:
     if not url:
         return ""
 
-    p = urlparse(url)
-    clean = urlunparse((
-        p.scheme,
-        p.netloc,
-        p.path.rstrip("/"),
-        "",  # query
-        ""   # fragment
-    ))
-    return clean
+    # 純字串切割：query / fragment 從第一個 ? 或 # 之後都不要
+    cut = len(url)
+    for ch in "?#":
+        i = url.find(ch, 0, cut)
+        if i >= 0:
+            cut = i
+    return url[:cut].rstrip("/")
 
 
-with open(DATA_PATH, "r", encoding="utf-8") as f:
-    data = json.load(f)
+data = read_json(DATA_PATH)
 
 products = data.get("products", [])
 original_count = len(products)
 
 print(f"原始商品數量: {original_count}")
 
-seen_urls = set()
+seen_urls = {}
 unique_products = []
 removed = []
 
@@ -46,8 +42,8 @@ for product in products:
         unique_products.append(product)
         continue
 
-    if norm_url not in seen_urls:
-        seen_urls.add(norm_url)
+    # setdefault 一次查表：第一次出現時存進去並回傳自己
+    if seen_urls.setdefault(norm_url, product) is product:
         product["url"] = norm_url   # 順便回寫乾淨 URL
         unique_products.append(product)
     else:
@@ -56,8 +52,7 @@ for product in products:
 
 data["products"] = unique_products
 
-with open(DATA_PATH, "w", encoding="utf-8") as f:
-    json.dump(data, f, ensure_ascii=False, indent=2)
+write_json(DATA_PATH, data)
 
 print("\n" + "=" * 50)
 print(f"去重後商品數量: {len(unique_products)}")
@@ -0,0 +1,153 @@
+# _image_fix_common.py
+# fix_images_* 腳本共用的部分：DB 備份、分批讀列、images 欄位解析/輸出、人工 mapping、子字串索引
+# 各腳本仍各自保留自己的比對規則，這裡只放原本逐檔複製的程式
+
+import re
+import json
+import shutil
+from bisect import bisect_right
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+FETCH_SIZE = 500  # SELECT 一次 fetchmany 的列數
+
+# 已是非空 JSON list 的列直接在 SQL 端略過；舊格式 ['x.jpg'] 等非合法 JSON 仍交給 safe_json_list 判斷
+SELECT_EMPTY_IMAGES_SQL = """
+    SELECT id, COALESCE(title,''), COALESCE(model,''), COALESCE(images,'')
+    FROM products
+    WHERE images IS NULL
+       OR NOT CASE WHEN json_valid(images)
+                   THEN json_type(images) = 'array' AND json_array_length(images) > 0
+                   ELSE 0 END
+"""
+
+# 你列的 miss（人工 mapping，確保一次補齊）
+MANUAL_MAPPING: Dict[str, str] = {
+    "積分球 ISP-XXXX": "ISP_XXXX_main.jpg",
+    "鍍金積分球 ISP-XXXGL": "ISP_XXXGL_main.jpg",
+    "IS治具": "IS_fixture_main.jpg",
+    "光通量(流明)量測系統 LM-ISP-XXXX": "LM_ISP_XXXX_main.jpg",
+    "CMOS影像(感測器)量測系統": "CMOS_main.jpg",
+    "廣角鏡頭量測-積分球均勻光源": "integrating_sphere_uniform_light_source_main.jpg",
+    "VCSEL量測儀": "VCSEL_main.jpg",
+}
+
+# MANUAL_MAPPING 的 key 編成一個 regex（長詞優先），每段文字只掃一次；lookahead 讓重疊的 key 也找得到
+_MANUAL_KEYS = sorted((k for k in MANUAL_MAPPING if k), key=len, reverse=True)
+_MANUAL_RE = re.compile("(?=(" + "|".join(map(re.escape, _MANUAL_KEYS)) + "))")
+# 同一起點只會命中最長的 key，較短的前綴 key 由這張表補上
+_MANUAL_PREFIXES = {k: [v for v in _MANUAL_KEYS if k.startswith(v)] for k in _MANUAL_KEYS}
+
+
+def manual_keys_in(*texts: str) -> set:
+    """回傳出現在任一段文字裡的 MANUAL_MAPPING key"""
+    hits = set()
+    for t in texts:
+        if not t:
+            continue
+        for m in _MANUAL_RE.finditer(t):
+            hits.update(_MANUAL_PREFIXES[m.group(1)])
+    return hits
+
+
+def iter_rows(cur, size: int = FETCH_SIZE):
+    """分批 fetchmany 逐列產出，不用 fetchall 把整張表一次搬進記憶體"""
+    cur.arraysize = size
+    while True:
+        rows = cur.fetchmany(size)
+        if not rows:
+            break
+        yield from rows
+
+
+def one_list(fn: str, ensure_ascii: bool = False) -> str:
+    """等同 json.dumps([fn], ensure_ascii=...)：一般 ASCII 檔名直接組字串，不必每列進 json encoder"""
+    if fn.isascii() and fn.isprintable():
+        return '["' + fn.replace("\\", "\\\\").replace('"', '\\"') + '"]'
+    return json.dumps([fn], ensure_ascii=ensure_ascii)
+
+
+def now_ts() -> str:
+    return datetime.now().strftime("%Y%m%d_%H%M%S")
+
+
+def backup_db(db_path: str) -> str:
+    src = Path(db_path)
+    if not src.exists():
+        raise FileNotFoundError(f"DB not found: {db_path}")
+    dst = src.with_suffix(src.suffix + f".bak_{now_ts()}")
+    shutil.copy2(src, dst)
+    return str(dst)
+
+
+def _legacy_json_list(s: str) -> List[str]:
+    # 舊格式：['x.jpg']
+    s = s.strip()
+    if s.startswith("[") and s.endswith("]") and "'" in s and '"' not in s:
+        try:
+            v2 = json.loads(s.replace("'", '"'))
+            return v2 if isinstance(v2, list) else []
+        except Exception:
+            return []
+    return []
+
+
+def safe_json_list(s: Optional[str]) -> List[str]:
+    # 每列都會呼叫：空值、"[]"、"''" 不必進 json.loads
+    if not s or s == "[]" or s == "''":
+        return []
+    if isinstance(s, list):
+        return [str(x) for x in s if x]
+    # 開頭是 [' 一定不是合法 JSON，直接走舊格式，省掉一次丟例外
+    if s[:2] == "['":
+        return _legacy_json_list(s)
+    try:
+        v = json.loads(s)
+        return v if isinstance(v, list) else []
+    except Exception:
+        return _legacy_json_list(str(s))
+
+
+class SubstringIndex:
+    """
+    等同依 image_map 順序找第一個 `key in k or k in key` 的值，但每個 key 只掃一次：
+    - k in key：全部 k 編成一個 regex（長詞優先 + lookahead），在 key 上 finditer
+    - key in k：全部 k 用 \\x00 串成一條字串，str.find 找出 key 落在哪些 k 裡
+    """
+
+    def __init__(self, image_map: dict):
+        self.keys = list(image_map)
+        self.values = list(image_map.values())
+        self.order = {k: i for i, k in enumerate(self.keys)}
+        nonempty = sorted((k for k in self.keys if k), key=len, reverse=True)
+        self.key_re = re.compile("(?=(" + "|".join(map(re.escape, nonempty)) + "))") if nonempty else None
+        # 同一起點 regex 只回最長的 k，較短的前綴 k 由這張表補上
+        self.prefixes = {k: [k[:j] for j in range(1, len(k) + 1) if k[:j] in self.order] for k in nonempty}
+        self.joined = "\x00".join(self.keys)
+        self.starts = []
+        pos = 0
+        for k in self.keys:
+            self.starts.append(pos)
+            pos += len(k) + 1
+
+    def first_match(self, key: str):
+        if not self.keys:
+            return None
+        if not key:
+            return self.values[0]  # "" in k 永遠成立
+
+        best = self.order.get("", len(self.keys))  # "" in key 永遠成立
+        if self.key_re is not None:
+            for m in self.key_re.finditer(key):
+                for k in self.prefixes[m.group(1)]:
+                    best = min(best, self.order[k])
+
+        i = self.joined.find(key)
+        while i != -1:
+            idx = bisect_right(self.starts, i) - 1
+            if i + len(key) <= self.starts[idx] + len(self.keys[idx]):
+                best = min(best, idx)
+            i = self.joined.find(key, i + 1)
+
+        return self.values[best] if best < len(self.keys) else None
@@ -11,14 +11,18 @@
 #   python tools/apply_image_mapping.py --dry-run
 #
 import os
+import sys
 import json
 import shutil
 import argparse
-import sqlite3
 from datetime import datetime
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 
-ALLOWED_EXT = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+
+ALLOWED_EXT = frozenset({".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff"})
 
 
 def now_tag() -> str:
@@ -31,19 +35,24 @@ def backup_db(db_path: str) -> str:
     return bak
 
 
-def load_mapping(path: str) -> Dict[str, str]:
+def load_mapping(path: str) -> Dict[str, Tuple[str, str]]:
+    """
+    回傳 title -> (正規化檔名, 要寫回 images 的 JSON 字串)
+    每個值只在載入時正規化 / json.dumps 一次
+    """
     with open(path, "r", encoding="utf-8") as f:
         payload = json.load(f)
     mapping = payload.get("mapping")
     if not isinstance(mapping, dict):
         raise ValueError("mapping_final.json 格式錯誤：找不到 mapping dict")
-    out: Dict[str, str] = {}
+    out: Dict[str, Tuple[str, str]] = {}
     for k, v in mapping.items():
         k2 = (k or "").strip()
         v2 = (v or "").strip().replace("\\", "/")
         if not k2 or not v2:
             continue
-        out[k2] = v2
+        fn = normalize_filename(v2)
+        out[k2] = (fn, json.dumps([fn], ensure_ascii=False))
     return out
 
 
@@ -54,8 +63,28 @@ def normalize_filename(fn: str) -> str:
 
 
 def is_allowed(fn: str) -> bool:
-    low = fn.lower()
-    return low.endswith(ALLOWED_EXT)
+    # 只取副檔名做 set 查詢，不必 lower 整個檔名
+    dot = fn.rfind(".")
+    return dot >= 0 and fn[dot:].lower() in ALLOWED_EXT
+
+
+def strip_title(v: Any) -> str:
+    """與 Python 端 (title or "").strip() 相同（SQLite trim 只去半形空白）"""
+    return (v or "").strip() if isinstance(v, str) else ""
+
+
+def has_images(v: Any) -> bool:
+    """images 欄位是否為非空 JSON list；None / 空字串 / "[]" / 非 list 直接判空，不必 json.loads"""
+    if not isinstance(v, str):
+        return False
+    s = v.strip()
+    if not s or s == "[]" or s[0] != "[":
+        return False
+    try:
+        j = json.loads(s)
+    except Exception:
+        return False
+    return isinstance(j, list) and len(j) > 0
 
 
 def main():
@@ -84,51 +113,49 @@ def main():
     skipped = 0
     bad_ext = 0
 
-    with sqlite3.connect(args.db, timeout=30) as conn:
-        conn.row_factory = sqlite3.Row
-
-        # 建 title->id
-        cur = conn.execute("SELECT id, title, images FROM products")
-        rows = cur.fetchall()
-
-        title_to_row = {}
-        for r in rows:
-            t = (r["title"] or "").strip()
-            if t:
-                title_to_row[t] = r
-
-        for title, fn in mapping.items():
-            r = title_to_row.get(title)
-            if not r:
+    updates: List[tuple] = []
+
+    with open_db(args.db) as conn:
+        conn.create_function("has_images", 1, has_images, deterministic=True)
+        conn.create_function("strip_title", 1, strip_title, deterministic=True)
+
+        # mapping 放進暫存表，交給 SQLite 比對，不必把整張 products 讀進 Python
+        conn.execute("CREATE TEMP TABLE mapping_in (title TEXT PRIMARY KEY)")
+        conn.executemany("INSERT INTO mapping_in (title) VALUES (?)", [(t,) for t in mapping])
+        # 每個 title 只對應一筆：同 title 多筆時取表中最後一筆（與原本 title -> row 的 dict 一樣後蓋前）
+        rows = conn.execute("""
+            WITH last AS (
+                SELECT strip_title(title) AS t, MAX(rowid) AS rid
+                FROM products
+                GROUP BY t
+            )
+            SELECT m.title, p.id, has_images(p.images)
+            FROM mapping_in m
+            LEFT JOIN last l ON l.t = m.title
+            LEFT JOIN products p ON p.rowid = l.rid
+        """).fetchall()
+        conn.execute("DROP TABLE mapping_in")
+
+        for title, pid, filled in rows:
+            if pid is None:
                 not_found += 1
                 continue
 
-            fn2 = normalize_filename(fn)
+            fn2, new_val = mapping[title]
             if not is_allowed(fn2):
                 bad_ext += 1
                 continue
 
-            if args.only_when_empty:
-                old_images = r["images"]
-                try:
-                    j = json.loads(old_images) if isinstance(old_images, str) and old_images.strip() else []
-                except Exception:
-                    j = []
-                if isinstance(j, list) and len(j) > 0:
-                    skipped += 1
-                    continue
-
-            new_val = json.dumps([fn2], ensure_ascii=False)
-
-            if args.dry_run:
-                updated += 1
+            if args.only_when_empty and filled:
+                skipped += 1
                 continue
 
-            conn.execute("UPDATE products SET images=? WHERE id=?", (new_val, r["id"]))
+            updates.append((new_val, pid))
             updated += 1
 
         if not args.dry_run:
-            conn.commit()
+            # with open_db(...) 結束時一起 commit：整批一個交易
+            conn.executemany("UPDATE products SET images=? WHERE id=?", updates)
 
     print("✅ apply_image_mapping 完成")
     if bak_path:
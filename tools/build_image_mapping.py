@@ -16,13 +16,31 @@
 #
 import os
 import re
+import sys
 import json
+import heapq
 import argparse
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 from difflib import SequenceMatcher
+from functools import lru_cache
 from typing import Dict, List, Any, Tuple, Optional
 
-ALLOWED_EXT = (".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff")
+try:
+    from rapidfuzz.fuzz import ratio as _rf_ratio
+except ImportError:  # 沒裝 rapidfuzz 時退回 difflib.SequenceMatcher（較慢）
+    _rf_ratio = None
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+
+ALLOWED_EXT = frozenset({".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp", ".tif", ".tiff"})
+
+# normalize_key 會跑 products × images 次，regex 先編好
+_IMG_PREFIX_RE = re.compile(r"^crawled_data/images/", re.IGNORECASE)
+_NONWORD_RE = re.compile(r"[^\w]+", re.UNICODE)
+_UND_RE = re.compile(r"_+")
 
 
 # -----------------------------
@@ -52,7 +70,7 @@ def norm_local_filename(s: str) -> str:
     if not s:
         return ""
     s = s.replace("\\", "/")
-    s = re.sub(r"^crawled_data/images/", "", s, flags=re.IGNORECASE)
+    s = _IMG_PREFIX_RE.sub("", s)
     s = s.lstrip("/")
     return s
 
@@ -66,6 +84,7 @@ STOP_WORDS = {
     "cmos", "image", "sensor", "camera",  # 這些有時是關鍵詞，先不強移除，只不加權
 }
 
+@lru_cache(maxsize=8192)
 def normalize_key(s: str) -> str:
     """
     把 title / filename 轉成可比對 key
@@ -81,8 +100,8 @@ def normalize_key(s: str) -> str:
     s = s.rsplit(".", 1)[0]  # 去 ext
     s = s.upper()
     s = s.replace("－", "-").replace("—", "-")
-    s = re.sub(r"[^\w]+", "_", s, flags=re.UNICODE)  # 非英數底線都變底線
-    s = re.sub(r"_+", "_", s).strip("_")
+    s = _NONWORD_RE.sub("_", s)  # 非英數底線都變底線
+    s = _UND_RE.sub("_", s).strip("_")
     return s
 
 
@@ -95,8 +114,14 @@ def tokens(s: str) -> List[str]:
 
 
 def ratio(a: str, b: str) -> float:
+    """
+    key 相似度（0~1）：有 rapidfuzz 用 Indel ratio（C++），否則用 SequenceMatcher
+    兩者都 <= 2*min(len)/(len 總和)，best_candidates 的剪枝上界依賴這點
+    """
     if not a or not b:
         return 0.0
+    if _rf_ratio is not None:
+        return _rf_ratio(a, b) / 100.0
     return SequenceMatcher(None, a, b).ratio()
 
 
@@ -124,10 +149,10 @@ def score_pair(title: str, filename: str) -> float:
 
     # 型號 token 加權
     model_bonus = 0.0
+    ftoks = set(tokens(filename))
     for tk in tokens(title):
-        if any(ch.isdigit() for ch in tk) and (len(tk) >= 3):
-            if tk in tokens(filename):
-                model_bonus += 0.05
+        if is_model_token(tk) and tk in ftoks:
+            model_bonus += 0.05
 
     return (base * 0.65) + (ov * 0.30) + min(model_bonus, 0.15)
 
@@ -153,19 +178,23 @@ def list_main_images(images_dir: str) -> List[str]:
     imgs: List[str] = []
     if not os.path.isdir(images_dir):
         return imgs
-    for fn in os.listdir(images_dir):
-        low = fn.lower()
-        if not low.endswith(ALLOWED_EXT):
-            continue
-        # 主圖規則：*_main.*
-        if "_main." not in low:
-            continue
-        imgs.append(fn)
+    with os.scandir(images_dir) as it:
+        for e in it:
+            fn = e.name
+            dot = fn.rfind(".")
+            if dot < 0 or fn[dot:].lower() not in ALLOWED_EXT:
+                continue
+            # 主圖規則：*_main.*
+            if "_main." not in fn.lower():
+                continue
+            if not e.is_file():
+                continue
+            imgs.append(fn)
     return sorted(imgs)
 
 
 def load_products(db_path: str) -> List[Dict[str, Any]]:
-    with sqlite3.connect(db_path, timeout=30) as conn:
+    with open_db(db_path) as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute("SELECT id, title, images FROM products")
         rows = cur.fetchall()
@@ -179,18 +208,123 @@ def load_products(db_path: str) -> List[Dict[str, Any]]:
     return out
 
 
-def best_candidates(title: str, main_images: List[str], topk: int) -> List[Dict[str, Any]]:
-    scored: List[Tuple[float, str]] = []
-    for fn in main_images:
-        s = score_pair(title, fn)
-        scored.append((s, fn))
-    scored.sort(key=lambda x: x[0], reverse=True)
+def is_model_token(tk: str) -> bool:
+    return any(ch.isdigit() for ch in tk) and (len(tk) >= 3)
+
+
+class ImageIndex:
+    """
+    圖檔那一側的 key / token 事先算好一次，每個產品只要算自己的 title
+    沒有 rapidfuzz 時，每張圖各留一個 SequenceMatcher（seq2 = 圖檔 key），b2j 只建一次
+    """
+
+    def __init__(self, main_images: List[str]):
+        self.filenames = list(main_images)
+        self.keys = [normalize_key(fn) for fn in self.filenames]
+        self.token_sets = [frozenset(tokens(fn)) for fn in self.filenames]
+        self.matchers = []
+        if _rf_ratio is None:
+            for k in self.keys:
+                sm = SequenceMatcher(None)
+                sm.set_seq2(k)
+                self.matchers.append(sm)
+
+    def key_ratio(self, i: int, tkey: str) -> float:
+        fkey = self.keys[i]
+        if not tkey or not fkey:
+            return 0.0
+        if _rf_ratio is not None:
+            return _rf_ratio(tkey, fkey) / 100.0
+        sm = self.matchers[i]
+        sm.set_seq1(tkey)
+        return sm.ratio()
+
+
+def best_candidates(title: str, index: ImageIndex, topk: int) -> List[Dict[str, Any]]:
+    """
+    分數與 score_pair 完全相同，但不對每張圖都算 ratio：
+    1) 先用 token 集合算 overlap / 型號加權（set 交集，便宜）
+    2) ratio 以長度上界 2*min/(la+lb) 代入，得到每張圖的分數上界
+    3) 依上界由高到低才真的算 ratio，上界已低於第 topk 名就停
+    """
+    topk = max(1, topk)
+    tkey = normalize_key(title)
+    ttoks = tokens(title)
+    tset = frozenset(ttoks)
+    tmodels = [tk for tk in ttoks if is_model_token(tk)]
+    la = len(tkey)
+
+    bounds: List[Tuple[float, int, float, float]] = []
+    for i, (fkey, fset) in enumerate(zip(index.keys, index.token_sets)):
+        if tset and fset:
+            ov = len(tset & fset) / max(len(tset), len(fset))
+        else:
+            ov = 0.0
+        model_bonus = 0.0
+        for tk in tmodels:
+            if tk in fset:
+                model_bonus += 0.05
+        ov_part = ov * 0.30
+        bonus = min(model_bonus, 0.15)
+        lb = len(fkey)
+        ub_ratio = (2.0 * min(la, lb) / (la + lb)) if (la and lb) else 0.0
+        bounds.append(((ub_ratio * 0.65) + ov_part + bonus, i, ov_part, bonus))
+    bounds.sort(key=lambda x: x[0], reverse=True)
+
+    scored: List[Tuple[float, int]] = []
+    top: List[float] = []  # 目前前 topk 名分數的 min-heap，top[0] 即第 topk 名
+    for ub, i, ov_part, bonus in bounds:
+        # 上界留一點浮點誤差的餘裕，避免同分邊界被剪掉
+        if len(top) >= topk and ub + 1e-9 < top[0]:
+            break
+        base = index.key_ratio(i, tkey)
+        score = (base * 0.65) + ov_part + bonus
+        scored.append((score, i))
+        if len(top) < topk:
+            heapq.heappush(top, score)
+        elif score > top[0]:
+            heapq.heapreplace(top, score)
+
+    # 同分時維持原本 main_images 的順序
+    scored.sort(key=lambda x: (-x[0], x[1]))
     out = []
-    for s, fn in scored[:max(1, topk)]:
-        out.append({"filename": fn, "score": round(float(s), 4)})
+    for s, i in scored[:topk]:
+        out.append({"filename": index.filenames[i], "score": round(float(s), 4)})
     return out
 
 
+# -----------------------------
+# multiprocessing：每個 worker 各自建一份 ImageIndex，只把 title 丟過去
+# -----------------------------
+_WORKER_INDEX: Optional[ImageIndex] = None
+
+
+def _init_worker(main_images: List[str]) -> None:
+    global _WORKER_INDEX
+    _WORKER_INDEX = ImageIndex(main_images)
+
+
+def _worker_candidates(job: Tuple[str, int]) -> List[Dict[str, Any]]:
+    title, topk = job
+    return best_candidates(title, _WORKER_INDEX, topk)
+
+
+def candidates_for_titles(titles: List[str], main_images: List[str], topk: int, workers: int) -> List[List[Dict[str, Any]]]:
+    """
+    每個 title 的候選彼此獨立：workers > 1 且量夠大時分給多個 process 算
+    - 預設 1：key 相似度走 rapidfuzz（C++）且有剪枝後，每個 title 的計算很小，
+      開 process 的啟動 / pickle 成本（Windows spawn 還要每個 worker 重新 import）反而划不來；
+      沒裝 rapidfuzz、退回純 Python SequenceMatcher 又資料量大時才值得開
+    """
+    if workers <= 1 or len(titles) < 2 * workers:
+        index = ImageIndex(main_images)
+        return [best_candidates(t, index, topk) for t in titles]
+    jobs = [(t, topk) for t in titles]
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(main_images,)) as ex:
+        return list(ex.map(_worker_candidates, jobs, chunksize=chunksize))
+
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--db", default=os.getenv("DB_PATH", "company_data.db"))
@@ -200,6 +334,7 @@ def main():
     ap.add_argument("--force", action="store_true", help="已有 images 也產生建議")
     ap.add_argument("--out_suggest", default="mapping_suggest.json")
     ap.add_argument("--out_final", default="mapping_final.json")
+    ap.add_argument("--workers", type=int, default=1, help="計算候選用的 process 數（1 = 不開多 process）")
     args = ap.parse_args()
 
     main_images = list_main_images(args.images)
@@ -240,17 +375,21 @@ def main():
     need_review = 0
     skipped_has_images = 0
 
+    todo: List[Tuple[Dict[str, Any], List[str]]] = []
     for p in products:
-        pid = p["id"]
-        title = p["title"]
         existing = [norm_local_filename(x) for x in (p["images"] or []) if norm_local_filename(x)]
 
         if (not args.force) and existing:
             skipped_has_images += 1
             continue
+        todo.append((p, existing))
+
+    # seed 已經填了也照算（仍放到 suggest 讓你知道候選）
+    all_candidates = candidates_for_titles([p["title"] for p, _ in todo], main_images, args.topk, args.workers)
 
-        # seed 已經填了就跳過（但仍可放到 suggest 讓你知道候選）
-        candidates = best_candidates(title, main_images, args.topk)
+    for (p, existing), candidates in zip(todo, all_candidates):
+        pid = p["id"]
+        title = p["title"]
 
         chosen = None
         if candidates and candidates[0]["score"] >= args.auto_threshold:
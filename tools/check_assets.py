@@ -1,15 +1,40 @@
 # tools/check_assets.py
-import os, json, re, sqlite3
+import os, sys, json, re
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
 
 DB = "company_data.db"
 IMG_DIR = "crawled_data/images"
 MD_DIR = "data/product_structured"
 
+# str 版 regex：\w 要涵蓋中文等 Unicode 字元（積分球_main.jpg 不能只抓到 _main.jpg）
+_IMG_RE = re.compile(r"\b([\w\-]+\.jpg)")
+
+
+def list_image_files():
+    """
+    IMG_DIR 底下的檔名一次列出來（一次 scandir，取代每個引用各 stat 一次）
+    - 一律轉小寫：與 Windows 上 os.path.isfile 一樣不分大小寫
+    """
+    if not os.path.isdir(IMG_DIR):
+        return set()
+    with os.scandir(IMG_DIR) as it:
+        return {e.name.lower() for e in it if e.is_file()}
+
 
 def main():
     missing = []
+    existing = list_image_files()
+
+    def image_exists(f):
+        # 含路徑的引用（子資料夾/絕對路徑）才退回 stat
+        if "/" in f or "\\" in f:
+            return os.path.isfile(os.path.join(IMG_DIR, f))
+        return f.lower() in existing
 
-    conn = sqlite3.connect(DB)
+    conn = open_db(DB)
     cur = conn.cursor()
 
     cur.execute("SELECT title, images FROM products")
@@ -20,18 +45,16 @@ def main():
             arr = []
 
         for f in arr:
-            p = os.path.join(IMG_DIR, f)
-            if not os.path.isfile(p):
+            if not image_exists(f):
                 missing.append(("DB", title, f))
 
     for fn in os.listdir(MD_DIR):
         if not fn.endswith(".md"): continue
         path = os.path.join(MD_DIR, fn)
-        text = open(path,encoding="utf8").read()
-
-        for im in re.findall(r"\b([\w\-]+\.jpg)", text):
-            p = os.path.join(IMG_DIR, im)
-            if not os.path.isfile(p):
+        with open(path,encoding="utf8") as fp:
+            text = fp.read()
+        for im in _IMG_RE.findall(text):
+            if im.lower() not in existing:
                 missing.append(("MD", fn, im))
 
     with open("missing_assets.json","w",encoding="utf8") as f:
@@ -1,17 +1,15 @@
 import os
 import re
-import sqlite3
+import sys
 import json
 import argparse
-import shutil
-from datetime import datetime
 
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+from _image_fix_common import backup_db  # noqa: E402
 
-def backup(db):
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    bk = f"{db}.bak_{ts}"
-    shutil.copy(db, bk)
-    print("✔ backup:", bk)
+_MODEL_RE = re.compile(r"[A-Z]{2,}[-_]?\d+[A-Z]*")
 
 
 def extract_model(title: str) -> str | None:
@@ -24,7 +22,7 @@ def extract_model(title: str) -> str | None:
         return None
 
     # 抓 英文+數字+-
-    m = re.findall(r"[A-Z]{2,}[-_]?\d+[A-Z]*", title.upper())
+    m = _MODEL_RE.findall(title.upper())
 
     if not m:
         return None
@@ -48,12 +46,14 @@ def main():
     if not os.path.isdir(img_dir):
         raise FileNotFoundError(img_dir)
 
-    backup(db)
+    print("✔ backup:", backup_db(db))
 
-    images = [
-        f for f in os.listdir(img_dir)
-        if f.lower().endswith("_main.jpg")
-    ]
+    # scandir 的 DirEntry 自帶檔案類型，不必另外 stat
+    with os.scandir(img_dir) as it:
+        images = [
+            e.name for e in it
+            if e.name.lower().endswith("_main.jpg") and e.is_file()
+        ]
 
     print("found images:", len(images))
 
@@ -63,13 +63,13 @@ def main():
         key = img.replace("_main.jpg", "").replace("_", "-").upper()
         image_map[key] = img
 
-    conn = sqlite3.connect(db)
+    conn = open_db(db)
     cur = conn.cursor()
 
     cur.execute("SELECT id, title, images FROM products")
     rows = cur.fetchall()
 
-    updated = 0
+    updates = []
     missed = []
 
     for pid, title, old_images in rows:
@@ -94,18 +94,19 @@ def main():
             continue
 
         new_images = json.dumps([matched], ensure_ascii=False)
+        updates.append((new_images, pid))
 
-        cur.execute("""
+    # 一次 executemany，整批在同一個交易裡
+    with conn:
+        conn.executemany("""
             UPDATE products
             SET images=?
             WHERE id=?
-        """, (new_images, pid))
-
-        updated += 1
-
-    conn.commit()
+        """, updates)
     conn.close()
 
+    updated = len(updates)
+
     print("\n==== RESULT ====")
     print("updated:", updated)
     print("missed:", len(missed))
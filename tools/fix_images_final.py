@@ -1,10 +1,12 @@
 import os
 import re
-import sqlite3
-import json
+import sys
 import argparse
-import shutil
-from datetime import datetime
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+from _image_fix_common import SubstringIndex, backup_db, iter_rows, one_list  # noqa: E402
 
 
 # ⭐ 人工補齊表
@@ -19,11 +21,14 @@ MANUAL_MAP = {
 }
 
 
-def backup(db):
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    bk = f"{db}.bak_{ts}"
-    shutil.copy(db, bk)
-    print("✔ backup:", bk)
+_KEY_TRANS = str.maketrans("_", "-")
+
+
+def image_key(img):
+    return img.replace("_main.jpg", "").translate(_KEY_TRANS).upper()
+
+
+_MODEL_RE = re.compile(r"[A-Z]{2,}[-_]?\d+[A-Z]*")
 
 
 def extract_model(title):
@@ -31,12 +36,13 @@ def extract_model(title):
     if not title:
         return None
 
-    m = re.findall(r"[A-Z]{2,}[-_]?\d+[A-Z]*", title.upper())
+    # 只要第一個型號，search 找到就停，不必 findall 掃完整串
+    m = _MODEL_RE.search(title.upper())
 
     if not m:
         return None
 
-    return m[0]
+    return m.group(0)
 
 
 def main():
@@ -50,42 +56,45 @@ def main():
     db = args.db
     img_dir = args.images_dir
 
-    backup(db)
+    print("✔ backup:", backup_db(db))
 
-    images = [
-        f for f in os.listdir(img_dir)
-        if f.lower().endswith("_main.jpg")
-    ]
+    # scandir 的 DirEntry 自帶檔案類型，不必另外 stat
+    with os.scandir(img_dir) as it:
+        images = [
+            e.name for e in it
+            if e.name.lower().endswith("_main.jpg") and e.is_file()
+        ]
 
-    image_map = {}
+    image_candidates = {}
 
     for img in images:
-        key = img.replace("_main.jpg", "").replace("_", "-").upper()
-        image_map[key] = img
+        image_candidates.setdefault(image_key(img), []).append(img)
+
+    # 同一個 key 有多張圖時沿用「後面覆蓋前面」，但列出來讓人工確認
+    image_map = {k: v[-1] for k, v in image_candidates.items()}
+    ambiguous = {k: v for k, v in image_candidates.items() if len(v) > 1}
+    if ambiguous:
+        print("⚠ ambiguous image keys:", len(ambiguous))
+        for k, v in ambiguous.items():
+            print(f"  - {k}: {v} -> {v[-1]}")
+
+    image_index = SubstringIndex(image_map)
 
-    conn = sqlite3.connect(db)
+    conn = open_db(db)
     cur = conn.cursor()
 
     cur.execute("SELECT id, title, images FROM products")
-    rows = cur.fetchall()
 
-    updated = 0
+    updates = []
     missed = []
 
-    for pid, title, old_images in rows:
+    for pid, title, old_images in iter_rows(cur):
 
         # ✅ 先吃人工表
         if title in MANUAL_MAP:
 
             img = MANUAL_MAP[title]
-
-            cur.execute("""
-                UPDATE products
-                SET images=?
-                WHERE id=?
-            """, (json.dumps([img]), pid))
-
-            updated += 1
+            updates.append((one_list(img, ensure_ascii=True), pid))
             continue
 
 
@@ -98,28 +107,25 @@ def main():
 
         key = model.replace("_", "-").upper()
 
-        matched = None
-
-        for k, v in image_map.items():
-            if key in k or k in key:
-                matched = v
-                break
+        matched = image_index.first_match(key)
 
         if not matched:
             missed.append(title)
             continue
 
-        cur.execute("""
+        updates.append((one_list(matched, ensure_ascii=True), pid))
+
+    # 一次 executemany，整批在同一個交易裡
+    with conn:
+        conn.executemany("""
             UPDATE products
             SET images=?
             WHERE id=?
-        """, (json.dumps([matched]), pid))
-
-        updated += 1
-
-    conn.commit()
+        """, updates)
     conn.close()
 
+    updated = len(updates)
+
     print("\n==== RESULT ====")
     print("updated:", updated)
     print("missed:", len(missed))
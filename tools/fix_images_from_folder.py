@@ -9,67 +9,47 @@
 
 import os
 import re
-import json
-import shutil
-import sqlite3
+import sys
 from pathlib import Path
-from datetime import datetime
 from difflib import get_close_matches
+from functools import lru_cache
 from typing import List, Dict, Optional
 
+try:
+    from rapidfuzz import fuzz, process
+except ImportError:  # 沒裝 rapidfuzz 時退回 difflib（較慢，結果相同）
+    fuzz = process = None
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+from _image_fix_common import (  # noqa: E402
+    MANUAL_MAPPING, SELECT_EMPTY_IMAGES_SQL, backup_db, iter_rows, manual_keys_in, one_list, safe_json_list,
+)
+
 DB_PATH = os.getenv("DB_PATH", "company_data.db")
 IMAGE_DIR = Path(os.getenv("IMAGE_DIR", r".\crawled_data\images"))
 DRY_RUN = os.getenv("DRY_RUN", "0") == "1"
 
-MANUAL_MAPPING: Dict[str, str] = {
-    "積分球 ISP-XXXX": "ISP_XXXX_main.jpg",
-    "鍍金積分球 ISP-XXXGL": "ISP_XXXGL_main.jpg",
-    "IS治具": "IS_fixture_main.jpg",
-    "光通量(流明)量測系統 LM-ISP-XXXX": "LM_ISP_XXXX_main.jpg",
-    "CMOS影像(感測器)量測系統": "CMOS_main.jpg",
-    "廣角鏡頭量測-積分球均勻光源": "integrating_sphere_uniform_light_source_main.jpg",
-    "VCSEL量測儀": "VCSEL_main.jpg",
-}
-
-def now_ts() -> str:
-    return datetime.now().strftime("%Y%m%d_%H%M%S")
-
-def backup_db(db_path: str) -> str:
-    src = Path(db_path)
-    if not src.exists():
-        raise FileNotFoundError(f"DB not found: {db_path}")
-    dst = src.with_suffix(src.suffix + f".bak_{now_ts()}")
-    shutil.copy2(src, dst)
-    return str(dst)
-
-def safe_json_list(s: Optional[str]) -> List[str]:
-    if not s:
-        return []
-    if isinstance(s, list):
-        return [str(x) for x in s if x]
-    try:
-        v = json.loads(s)
-        return v if isinstance(v, list) else []
-    except Exception:
-        s = str(s).strip()
-        if s.startswith("[") and s.endswith("]") and "'" in s and '"' not in s:
-            try:
-                v2 = json.loads(s.replace("'", '"'))
-                return v2 if isinstance(v2, list) else []
-            except Exception:
-                return []
-        return []
+_WS_RE = re.compile(r"\s+")
+_NONALNUM_RE = re.compile(r"[^a-z0-9\u4e00-\u9fff_]+")
 
+@lru_cache(maxsize=4096)
 def normalize(s: str) -> str:
     s = (s or "").strip().lower()
     s = s.replace("-", "_")
-    s = re.sub(r"\s+", "_", s)
-    s = re.sub(r"[^a-z0-9\u4e00-\u9fff_]+", "", s)
+    s = _WS_RE.sub("_", s)
+    s = _NONALNUM_RE.sub("", s)
     return s
 
 def pick_best_image_for_key(key_norm: str, candidates_norm: List[str], norm_to_filename: Dict[str, str]) -> Optional[str]:
     if not key_norm:
         return None
+    if process is not None:
+        # Indel ratio >= difflib ratio，先用 rapidfuzz（C++）篩出可能過 0.55 的少數候選，
+        # 再只對這些跑 get_close_matches，結果與直接對全部候選跑完全相同
+        hits = process.extract(key_norm, candidates_norm, scorer=fuzz.ratio, limit=None, score_cutoff=54.9)
+        candidates_norm = [m for m, _, _ in hits]
     matches = get_close_matches(key_norm, candidates_norm, n=8, cutoff=0.55)
     if not matches:
         return None
@@ -88,43 +68,44 @@ def main():
     if not IMAGE_DIR.exists():
         raise FileNotFoundError(f"Image dir not found: {IMAGE_DIR}")
 
-    all_jpg = list(IMAGE_DIR.glob("*.jpg"))
-    main_jpg = [p for p in all_jpg if p.name.lower().endswith("_main.jpg")]
-    preferred = main_jpg + [p for p in all_jpg if p not in main_jpg]
+    # scandir + 字尾判斷取代 glob("*.jpg")（glob 每次都要把 pattern 轉成 regex）；字尾不分大小寫，.JPG 也算
+    with os.scandir(IMAGE_DIR) as it:
+        all_jpg = [e.name for e in it if e.name.lower().endswith(".jpg") and e.is_file()]
+    main_jpg = [n for n in all_jpg if n.lower().endswith("_main.jpg")]
+    preferred = main_jpg + [n for n in all_jpg if not n.lower().endswith("_main.jpg")]
 
     norm_to_filename: Dict[str, str] = {}
     candidates_norm: List[str] = []
-    for p in preferred:
-        stem_norm = normalize(p.stem)
+    for name in preferred:
+        stem_norm = normalize(name[:-len(".jpg")])
         if stem_norm not in norm_to_filename:
-            norm_to_filename[stem_norm] = p.name
+            norm_to_filename[stem_norm] = name
             candidates_norm.append(stem_norm)
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, COALESCE(title,''), COALESCE(model,''), COALESCE(images,'') FROM products")
-        rows = cur.fetchall()
+        cur.execute(SELECT_EMPTY_IMAGES_SQL)
 
         updated = 0
+        updates = []
         missed = []
 
-        for pid, title, model, images in rows:
+        for pid, title, model, images in iter_rows(cur):
             if safe_json_list(images):
                 continue
 
             # 1) manual
             hit = None
+            manual_keys = manual_keys_in(title, model)
             for k, fn in MANUAL_MAPPING.items():
-                if k and (k in title or k in model):
+                if k in manual_keys:
                     if (IMAGE_DIR / fn).exists():
                         hit = fn
                         break
             if hit:
                 print(f"[MANUAL] id={pid} title={title} -> {hit}")
-                if not DRY_RUN:
-                    cur.execute("UPDATE products SET images=? WHERE id=?",
-                                (json.dumps([hit], ensure_ascii=False), pid))
+                updates.append((one_list(hit), pid))
                 updated += 1
                 continue
 
@@ -142,15 +123,15 @@ def main():
 
             if fn:
                 print(f"[STRICT] id={pid} model={model} title={title} -> {fn}")
-                if not DRY_RUN:
-                    cur.execute("UPDATE products SET images=? WHERE id=?",
-                                (json.dumps([fn], ensure_ascii=False), pid))
+                updates.append((one_list(fn), pid))
                 updated += 1
             else:
                 missed.append((pid, title, model))
 
         if not DRY_RUN:
-            conn.commit()
+            # 一次 executemany，整批在同一個交易裡
+            with conn:
+                conn.executemany("UPDATE products SET images=? WHERE id=?", updates)
 
         print("\n========== SUMMARY ==========")
         print(f"updated: {updated}")
@@ -1,12 +1,19 @@
 import os
 import re
-import sqlite3
-import json
+import sys
 import argparse
-import shutil
-from datetime import datetime
+from functools import lru_cache
 
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+from _image_fix_common import SubstringIndex, backup_db, iter_rows, one_list  # noqa: E402
 
+
+_NONWORD_RE = re.compile(r"[^\w]")
+
+
+@lru_cache(maxsize=4096)
 def normalize(text: str) -> str:
     """標準化名稱，用來模糊比對"""
     if not text:
@@ -15,18 +22,11 @@ def normalize(text: str) -> str:
     text = text.lower()
 
     # 移除中文、符號、空白
-    text = re.sub(r"[^\w]", "", text)
+    text = _NONWORD_RE.sub("", text)
 
     return text
 
 
-def backup_db(db_path):
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    backup = f"{db_path}.bak_{ts}"
-    shutil.copy(db_path, backup)
-    print(f"✔ DB backup: {backup}")
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--db", required=True)
@@ -43,60 +43,66 @@ def main():
     if not os.path.isdir(img_dir):
         raise FileNotFoundError(img_dir)
 
-    backup_db(db_path)
+    print(f"✔ DB backup: {backup_db(db_path)}")
 
     # 讀圖片
-    images = [
-        f for f in os.listdir(img_dir)
-        if f.lower().endswith("_main.jpg")
-    ]
+    # scandir 的 DirEntry 自帶檔案類型，不必另外 stat
+    with os.scandir(img_dir) as it:
+        images = [
+            e.name for e in it
+            if e.name.lower().endswith("_main.jpg") and e.is_file()
+        ]
 
     print("found images:", len(images))
 
-    img_map = {}
+    img_candidates = {}
 
     for img in images:
-        key = normalize(img.replace("_main.jpg", ""))
-        img_map[key] = img
+        img_candidates.setdefault(normalize(img.replace("_main.jpg", "")), []).append(img)
+
+    # 同一個 key 有多張圖時沿用「後面覆蓋前面」，但列出來讓人工確認
+    img_map = {k: v[-1] for k, v in img_candidates.items()}
+    ambiguous = {k: v for k, v in img_candidates.items() if len(v) > 1}
+    if ambiguous:
+        print("⚠ ambiguous image keys:", len(ambiguous))
+        for k, v in ambiguous.items():
+            print(f"  - {k}: {v} -> {v[-1]}")
 
-    conn = sqlite3.connect(db_path)
+    img_index = SubstringIndex(img_map)
+
+    conn = open_db(db_path)
     cur = conn.cursor()
 
     cur.execute("SELECT id, title, images FROM products")
-    rows = cur.fetchall()
 
-    updated = 0
+    updates = []
     missed = []
 
-    for pid, title, images_json in rows:
+    for pid, title, images_json in iter_rows(cur):
 
         key = normalize(title)
 
-        matched = None
-
-        # 嘗試模糊匹配
-        for k, v in img_map.items():
-            if k in key or key in k:
-                matched = v
-                break
+        # 嘗試模糊匹配（雙向子字串）
+        matched = img_index.first_match(key)
 
         if not matched:
             missed.append(title)
             continue
 
-        new_images = json.dumps([matched], ensure_ascii=False)
+        new_images = one_list(matched)
+        updates.append((new_images, pid))
 
-        cur.execute("""
+    # 一次 executemany，整批在同一個交易裡
+    with conn:
+        conn.executemany("""
             UPDATE products
             SET images=?
             WHERE id=?
-        """, (new_images, pid))
-
-        updated += 1
-
-    conn.commit()
+        """, updates)
     conn.close()
 
+    updated = len(updates)
+
     print("\n==== RESULT ====")
     print("updated:", updated)
     print("missed:", len(missed))
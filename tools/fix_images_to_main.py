@@ -7,29 +7,30 @@
 
 import os
 import re
-import json
-import shutil
+import sys
 import sqlite3
 from pathlib import Path
-from datetime import datetime
+from collections import defaultdict
+from functools import lru_cache
 from difflib import SequenceMatcher
 from typing import Dict, List, Tuple, Optional
 
+try:
+    from rapidfuzz import fuzz
+except ImportError:  # 沒裝 rapidfuzz 時退回 difflib.SequenceMatcher（較慢）
+    fuzz = None
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
+from _image_fix_common import (  # noqa: E402
+    MANUAL_MAPPING, SELECT_EMPTY_IMAGES_SQL, backup_db, iter_rows, manual_keys_in, one_list, safe_json_list,
+)
+
 DB_PATH = os.getenv("DB_PATH", "company_data.db")
 IMAGE_DIR = Path(os.getenv("IMAGE_DIR", r".\crawled_data\images"))
 DRY_RUN = os.getenv("DRY_RUN", "0") == "1"  # 1=只顯示不寫入
 
-# 你列的 miss（人工 mapping，確保一次補齊）
-MANUAL_MAPPING: Dict[str, str] = {
-    "積分球 ISP-XXXX": "ISP_XXXX_main.jpg",
-    "鍍金積分球 ISP-XXXGL": "ISP_XXXGL_main.jpg",
-    "IS治具": "IS_fixture_main.jpg",
-    "光通量(流明)量測系統 LM-ISP-XXXX": "LM_ISP_XXXX_main.jpg",
-    "CMOS影像(感測器)量測系統": "CMOS_main.jpg",
-    "廣角鏡頭量測-積分球均勻光源": "integrating_sphere_uniform_light_source_main.jpg",
-    "VCSEL量測儀": "VCSEL_main.jpg",
-}
-
 ALIAS_MAP: Dict[str, List[str]] = {
     "isp-xxxx": ["isp_xxxx", "integrating_sphere", "lm_isp_xxxx"],
     "isp-xxxgl": ["isp_xxxgl", "integrating_sphere"],
@@ -41,57 +42,40 @@ ALIAS_MAP: Dict[str, List[str]] = {
     "均勻光源": ["uniform_light_source", "integrating_sphere_uniform_light_source"],
 }
 
-def now_ts() -> str:
-    return datetime.now().strftime("%Y%m%d_%H%M%S")
-
-def backup_db(db_path: str) -> str:
-    src = Path(db_path)
-    if not src.exists():
-        raise FileNotFoundError(f"DB not found: {db_path}")
-    dst = src.with_suffix(src.suffix + f".bak_{now_ts()}")
-    shutil.copy2(src, dst)
-    return str(dst)
-
-def safe_json_list(s: Optional[str]) -> List[str]:
-    if not s:
-        return []
-    if isinstance(s, list):
-        return [str(x) for x in s if x]
-    try:
-        v = json.loads(s)
-        return v if isinstance(v, list) else []
-    except Exception:
-        # 舊格式：['x.jpg']
-        s = str(s).strip()
-        if s.startswith("[") and s.endswith("]") and "'" in s and '"' not in s:
-            try:
-                v2 = json.loads(s.replace("'", '"'))
-                return v2 if isinstance(v2, list) else []
-            except Exception:
-                return []
-        return []
+_SPACE_RE = re.compile(r"[\s/]+")
+_NONALNUM_RE = re.compile(r"[^a-z0-9\u4e00-\u9fff_() ]+")
+_TOKEN_SPLIT_RE = re.compile(r"[ _()]+")
 
+# 同一個 title / model / 檔名會被正規化好幾次（manual、alias、評分），純函式直接快取
+@lru_cache(maxsize=4096)
 def normalize_text(s: str) -> str:
     s = (s or "").strip().lower()
     s = s.replace("（", "(").replace("）", ")")
-    s = re.sub(r"[\s/]+", " ", s)
+    s = _SPACE_RE.sub(" ", s)
     s = s.replace("-", "_")
-    s = re.sub(r"[^a-z0-9\u4e00-\u9fff_() ]+", "", s)
+    s = _NONALNUM_RE.sub("", s)
     return s
 
-def tokens_from_text(s: str) -> List[str]:
+@lru_cache(maxsize=4096)
+def tokens_from_text(s: str) -> Tuple[str, ...]:
     s = normalize_text(s)
-    parts = re.split(r"[ _()]+", s)
-    return [p for p in parts if p]
+    parts = _TOKEN_SPLIT_RE.split(s)
+    return tuple(p for p in parts if p)
 
 def similarity(a: str, b: str) -> float:
+    if fuzz is not None:
+        return fuzz.ratio(a, b) / 100.0
     return SequenceMatcher(None, a, b).ratio()
 
+def count_products(conn: sqlite3.Connection) -> int:
+    return conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+
 def load_products(conn: sqlite3.Connection):
+    """只載入 images 可能為空的產品（其餘在 SQL 端就略過）"""
     cur = conn.cursor()
-    cur.execute("SELECT id, COALESCE(title,''), COALESCE(model,''), COALESCE(images,'') FROM products")
+    cur.execute(SELECT_EMPTY_IMAGES_SQL)
     out = []
-    for pid, title, model, images in cur.fetchall():
+    for pid, title, model, images in iter_rows(cur):
         out.append({
             "id": pid,
             "title": title,
@@ -102,25 +86,61 @@ def load_products(conn: sqlite3.Connection):
 
 def collect_main_images(image_dir: Path):
     items = []
-    for p in image_dir.glob("*_main.jpg"):
-        stem_norm = normalize_text(p.stem)
+    with os.scandir(image_dir) as it:
+        names = [e.name for e in it if e.name.lower().endswith("_main.jpg") and e.is_file()]
+    for name in names:
+        stem_norm = normalize_text(name[:-len(".jpg")])
         items.append({
-            "filename": p.name,
+            "filename": name,
             "stem_norm": stem_norm,
             "tokens": tokens_from_text(stem_norm),
         })
     return items
 
+def build_stem_index(images) -> Dict[str, int]:
+    """正規化後的檔名 stem -> 圖片 index（同名取第一張，與評分時同分取先出現者一致）"""
+    index: Dict[str, int] = {}
+    for i, im in enumerate(images):
+        index.setdefault(im["stem_norm"], i)
+    return index
+
+def exact_model_match(pr, images, stem_index: Dict[str, int]) -> Optional[Tuple[str, float]]:
+    """model 正規化後剛好等於某張 <model>_main.jpg：直接採用，不必進相似度評分"""
+    model_norm = normalize_text(pr["model"])
+    if not model_norm:
+        return None
+    i = stem_index.get(model_norm + "_main")
+    if i is None:
+        return None
+    return images[i]["filename"], 1.0
+
 def apply_manual_mapping(products, image_set: set) -> Dict[int, str]:
     result = {}
     for pr in products:
+        hits = manual_keys_in(pr["title"], pr["model"])
+        if not hits:
+            continue
         for k, fn in MANUAL_MAPPING.items():
-            if k and (k in pr["title"] or k in pr["model"]):
-                if fn in image_set:
-                    result[pr["id"]] = fn
+            if k in hits and fn in image_set:
+                result[pr["id"]] = fn
     return result
 
-def best_match_for_product(pr, images) -> Tuple[Optional[str], float]:
+def build_token_index(images) -> Dict[str, List[int]]:
+    """
+    token -> 含這個 token 的圖片 index（遞增）
+    同一張圖重複出現的 token 會記多次，與 token_score 逐一計數的算法一致
+    """
+    index: Dict[str, List[int]] = defaultdict(list)
+    for i, im in enumerate(images):
+        for t in im["tokens"]:
+            index[t].append(i)
+    return index
+
+def best_match_for_product(pr, images, token_index: Optional[Dict[str, List[int]]] = None) -> Tuple[Optional[str], float]:
+    """
+    token_index 有給時只評分與產品至少共用一個 token 的圖片：
+    沒共用 token 的圖 token_score = 0，分數最多 0.35，本來就過不了 0.58 門檻
+    """
     base_text = f"{pr['title']} {pr['model']}"
     base_norm = normalize_text(base_text)
     prod_tokens = set(tokens_from_text(base_norm))
@@ -136,8 +156,24 @@ def best_match_for_product(pr, images) -> Tuple[Optional[str], float]:
     best_fn = None
     best_score = 0.0
 
-    for im in images:
-        hits = sum(1 for t in im["tokens"] if t in prod_tokens)
+    hit_counts: Optional[Dict[int, int]] = None
+    if token_index is not None:
+        # 沿著 inverted index 一次數完每張圖命中幾個 token，不必逐張圖掃 token
+        hit_counts = defaultdict(int)
+        for t in prod_tokens:
+            for i in token_index.get(t, ()):
+                hit_counts[i] += 1
+        # 依原本圖片順序評分，同分時挑到的圖與全掃相同
+        candidates = sorted(hit_counts)
+    else:
+        candidates = range(len(images))
+
+    for i in candidates:
+        im = images[i]
+        if hit_counts is not None:
+            hits = hit_counts[i]
+        else:
+            hits = sum(1 for t in im["tokens"] if t in prod_tokens)
         token_score = hits / max(1, len(im["tokens"]))
         sim_score = max(similarity(base_norm, im["stem_norm"]),
                         similarity(normalize_text(pr["model"]), im["stem_norm"]) if pr["model"] else 0.0)
@@ -148,10 +184,11 @@ def best_match_for_product(pr, images) -> Tuple[Optional[str], float]:
 
     return best_fn, best_score
 
-def update_product_image(conn: sqlite3.Connection, pid: int, filename: str):
-    cur = conn.cursor()
-    cur.execute("UPDATE products SET images=? WHERE id=?",
-                (json.dumps([filename], ensure_ascii=False), pid))
+def update_product_images(conn: sqlite3.Connection, updates: List[Tuple[int, str]]):
+    """updates = [(pid, filename), ...]；一次 executemany，整批在同一個交易裡"""
+    with conn:
+        conn.executemany("UPDATE products SET images=? WHERE id=?",
+                         [(one_list(fn), pid) for pid, fn in updates])
 
 def main():
     print(f"[INFO] DB_PATH: {DB_PATH}")
@@ -161,19 +198,23 @@ def main():
     backup_path = backup_db(DB_PATH)
     print(f"[OK] DB backup created: {backup_path}")
 
-    conn = sqlite3.connect(DB_PATH)
+    conn = open_db(DB_PATH)
     try:
+        total_products = count_products(conn)
         products = load_products(conn)
         main_images = collect_main_images(IMAGE_DIR)
         image_set = {im["filename"] for im in main_images}
 
-        print(f"[INFO] products: {len(products)}")
+        print(f"[INFO] products: {total_products}")
         print(f"[INFO] found main images: {len(main_images)}")
 
         manual_hits = apply_manual_mapping(products, image_set)
+        token_index = build_token_index(main_images)
+        stem_index = build_stem_index(main_images)
 
         updated = 0
-        skipped_has_value = 0
+        updates: List[Tuple[int, str]] = []
+        skipped_has_value = total_products - len(products)
         missed = []
 
         # 先人工 mapping
@@ -184,26 +225,27 @@ def main():
             if pr["id"] in manual_hits:
                 fn = manual_hits[pr["id"]]
                 print(f"[MANUAL] id={pr['id']} title={pr['title']} -> {fn}")
-                if not DRY_RUN:
-                    update_product_image(conn, pr["id"], fn)
+                updates.append((pr["id"], fn))
                 updated += 1
 
         # 再自動匹配
-        for pr in products:
-            if pr["images"] or pr["id"] in manual_hits:
-                continue
-
-            fn, score = best_match_for_product(pr, main_images)
+        todo = [pr for pr in products if not pr["images"] and pr["id"] not in manual_hits]
+        # model 剛好對到檔名的先直接採用，剩下的才評分
+        exact_hits = [exact_model_match(pr, main_images, stem_index) for pr in todo]
+        rest = [pr for pr, hit in zip(todo, exact_hits) if hit is None]
+        rest_results = iter([best_match_for_product(pr, main_images, token_index) for pr in rest])
+        results = [hit if hit is not None else next(rest_results) for hit in exact_hits]
+
+        for pr, (fn, score) in zip(todo, results):
             if fn and score >= 0.58:
                 print(f"[AUTO] id={pr['id']} score={score:.3f} title={pr['title']} model={pr['model']} -> {fn}")
-                if not DRY_RUN:
-                    update_product_image(conn, pr["id"], fn)
+                updates.append((pr["id"], fn))
                 updated += 1
             else:
                 missed.append((pr["id"], pr["title"], pr["model"], score, fn))
 
         if not DRY_RUN:
-            conn.commit()
+            update_product_images(conn, updates)
 
         print("\n========== SUMMARY ==========")
         print(f"skipped(has images already): {skipped_has_value}")
@@ -1,4 +1,8 @@
-import sqlite3, json
+import os, sys, json
+
+# tools/ 底下的腳本以 `python tools/xxx.py` 執行，需把專案根目錄加進 sys.path 才拿得到 db_utils
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_utils import open_db  # noqa: E402
 
 DB = "company_data.db"
 
@@ -8,7 +12,7 @@ FIX = {
 }
 
 def main():
-    conn = sqlite3.connect(DB)
+    conn = open_db(DB)
     cur = conn.cursor()
 
     for title, fn in FIX.items():
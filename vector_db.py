@@ -1,17 +1,37 @@
 # vector_db.py (Incremental Chroma Updater + Manifest per-file + Scope + Status) - UPGRADED
 import os
 import re
-import glob
 import json
 import time
 import hashlib
+import heapq
 import logging
+import mmap
+import queue
 import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
 
 import chromadb
 from chromadb.utils import embedding_functions
 
+try:
+    import orjson
+except ImportError:  # orjson 為選配：沒裝就退回標準 json
+    orjson = None
+
+# fingerprint 只用來判斷檔案有沒有變，不需要密碼學強度：有 blake3 / xxh3 就用，比 sha256 快很多
+try:
+    from blake3 import blake3 as _fp_hash
+    FP_HASH_NAME = "blake3"
+except ImportError:
+    try:
+        from xxhash import xxh3_128 as _fp_hash
+        FP_HASH_NAME = "xxh3_128"
+    except ImportError:  # 都沒裝時維持 sha256（fp 與舊 manifest 相同，不會觸發重建）
+        _fp_hash = hashlib.sha256
+        FP_HASH_NAME = "sha256"
+
 logger = logging.getLogger("vector-db")
 
 
@@ -30,16 +50,65 @@ def chunk_text(text: str, chunk_size: int = 900, overlap: int = 120) -> List[str
     chunk_size = max(200, int(chunk_size))
     overlap = max(0, min(int(overlap), chunk_size - 50))
 
-    chunks: List[str] = []
-    i = 0
-    n = len(text)
-    while i < n:
-        j = min(n, i + chunk_size)
-        chunks.append(text[i:j])
-        if j >= n:
-            break
-        i = max(0, j - overlap)
-    return chunks
+    # 每段起點固定是 step 的倍數，直接用 range 算出來；最後一段是第一個碰到結尾的（起點 < n - overlap）
+    step = chunk_size - overlap
+    return [text[i : i + chunk_size] for i in range(0, max(len(text) - overlap, 1), step)]
+
+
+DOC_EXTS = (".md", ".txt")
+
+
+def _sorted_entries(d: str, dir_stamps: Optional[List[Tuple[str, int]]] = None) -> List[Tuple[str, str, bool]]:
+    """
+    單一目錄底下的 (排序 key, path, 是否目錄)，略過 . 開頭的檔案 / 目錄
+    - 目錄的 key 是 name + "/"：依這個 key 深度優先走，產出順序就等於整條路徑字串排序
+    """
+    entries: List[Tuple[str, str, bool]] = []
+    try:
+        it = os.scandir(d)
+        if dir_stamps is not None:
+            dir_stamps.append((d, os.stat(d).st_mtime_ns))
+    except OSError:
+        return entries
+    with it:
+        for e in it:
+            if e.name.startswith("."):
+                continue
+            try:
+                if e.is_dir():
+                    entries.append((e.name + "/", e.path, True))
+                elif e.is_file() and e.name.lower().endswith(DOC_EXTS):
+                    entries.append((e.name, e.path, False))
+            except OSError:
+                continue
+    entries.sort()
+    return entries
+
+
+def _iter_docs(root: str, dir_stamps: Optional[List[Tuple[str, int]]] = None):
+    """
+    遞迴列出 root 底下的 .md / .txt：一次 scandir 走完，DirEntry 自帶檔案類型，不必 glob 兩次
+    - 跟 glob 的 ** 一樣略過 . 開頭的檔案 / 目錄
+    - 依路徑排序產出，呼叫端不必再整批 sort
+    - dir_stamps 有給時，順便記下每個走過的目錄 (path, st_mtime_ns)
+    """
+    stack = [iter(_sorted_entries(root, dir_stamps))]
+    while stack:
+        for _, path, is_dir in stack[-1]:
+            if is_dir:
+                stack.append(iter(_sorted_entries(path, dir_stamps)))
+                break
+            yield path
+        else:
+            stack.pop()
+
+
+def _dirs_unchanged(dir_stamps: List[Tuple[str, int]]) -> bool:
+    # 目錄裡新增 / 刪除 / 改名檔案都會更新該目錄的 mtime
+    try:
+        return all(os.stat(d).st_mtime_ns == m for d, m in dir_stamps)
+    except OSError:
+        return False
 
 
 def _norm_path(p: str) -> str:
@@ -47,28 +116,45 @@ def _norm_path(p: str) -> str:
     return os.path.normpath(p).replace("\\", "/")
 
 
+_SAFE_ID_RE = re.compile(r"[^a-zA-Z0-9_\-:./]+")
+
+
 def _safe_id(s: str) -> str:
     s = _norm_path(s)
-    s = re.sub(r"[^a-zA-Z0-9_\-:./]+", "_", s)
+    s = _SAFE_ID_RE.sub("_", s)
     return s
 
 
+def _chunk_id_prefix(norm_p: str) -> str:
+    # "::chunk{idx}" 全是允許字元：_safe_id(f"{norm_p}::chunk") + str(idx) 與逐個 chunk 呼叫 _safe_id 結果相同
+    return _safe_id(f"{norm_p}::chunk")
+
+
 # -----------------------------
 # Fingerprint mode
 # -----------------------------
-def _file_fingerprint_stat(path: str) -> str:
+def _stat_tuple(path: str) -> Tuple[int, int]:
+    """(mtime_ns, size)；stat 失敗回 (0, 0)。奈秒只用在「能否沿用 manifest 裡的舊 fp」的判斷"""
+    try:
+        st = os.stat(path)
+        return int(st.st_mtime_ns), int(st.st_size)
+    except Exception:
+        return 0, 0
+
+
+def _file_fingerprint_stat(path: str, st: Optional[Tuple[int, int]] = None) -> str:
     """
     ✅ 快速 fingerprint：hash(path + mtime + size)
+    - st: 呼叫端已經 stat 過的 (mtime_ns, size)，有給就不再 stat 一次
+    - hash 裡的 mtime 仍用整數秒，維持與舊 manifest 相同的 fp（不會因此整庫重建）
+    - 所以同一秒內改動、大小又沒變的檔案，stat fp 不會變、也不會重建；
+      要分辨這種改動請用 VDB_FINGERPRINT_MODE=content
     """
     p2 = _norm_path(path)
-    try:
-        st = os.stat(path)
-        mtime = int(st.st_mtime)
-        size = int(st.st_size)
-    except Exception:
-        mtime, size = 0, 0
+    mtime_ns, size = st if st is not None else _stat_tuple(path)
+    mtime = mtime_ns // 1_000_000_000
     raw = f"{p2}\t{mtime}\t{size}".encode("utf-8", errors="ignore")
-    return hashlib.sha256(raw).hexdigest()
+    return _fp_hash(raw).hexdigest()
 
 
 def _file_fingerprint_content(path: str, max_bytes: int = 32 * 1024 * 1024) -> str:
@@ -76,18 +162,15 @@ def _file_fingerprint_content(path: str, max_bytes: int = 32 * 1024 * 1024) -> s
     ✅ 內容 fingerprint：hash(file bytes)（較慢，但更準）
     - max_bytes: 避免超大檔案拖垮；超過就只 hash 前 max_bytes（可接受）
     """
-    h = hashlib.sha256()
+    h = _fp_hash()
     try:
         with open(path, "rb") as f:
-            remain = max_bytes
-            while True:
-                if remain <= 0:
-                    break
-                chunk = f.read(min(1024 * 1024, remain))
-                if not chunk:
-                    break
-                h.update(chunk)
-                remain -= len(chunk)
+            size = os.fstat(f.fileno()).st_size
+            # 空檔無法 mmap；不 update 就等同 hash 空內容
+            if size > 0:
+                # mmap 直接把 page cache 交給 hash，不必每 1MB 配置一個 bytes
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as mv:
+                    h.update(mv[: min(size, max_bytes)])
     except Exception:
         return _file_fingerprint_stat(path)
 
@@ -104,12 +187,68 @@ def _choose_fingerprint_fn():
 
 
 FINGERPRINT_FN = _choose_fingerprint_fn()
+# 寫進 manifest 的 fingerprint_mode，連同 hash 演算法一起記，換演算法時看得出 fp 為何全變
+FINGERPRINT_MODE_LABEL = f"{os.getenv('VDB_FINGERPRINT_MODE', 'stat')}-{FP_HASH_NAME}"
+
+# fingerprint 幾乎都在等 stat / read（hashlib 讀大塊資料時也會放掉 GIL），用 thread 讓 I/O 重疊
+FP_WORKERS = max(1, int(os.getenv("VDB_FP_WORKERS", "16")))
+
+
+def _file_entry(
+    real_p: str,
+    chunks: int,
+    prev: Optional[Dict[str, Any]] = None,
+    chunk_fps: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """
+    manifest 裡單一檔案的紀錄：fp + mtime_ns/size + chunks + 每個 chunk 的 fp
+    - prev 的 mtime_ns/size 與現在相同時直接沿用舊 fp，不重算 hash（content 模式也一樣）
+    - mtime_ns 不同時重算 fp；content 模式會重新 hash 內容，stat 模式仍只看整數秒（見 _file_fingerprint_stat）
+    - 舊 manifest 只有秒級 mtime：比對不到 mtime_ns，第一次會重算 fp
+    """
+    mtime_ns, size = _stat_tuple(real_p)
+    if prev and mtime_ns and prev.get("fp") and prev.get("mtime_ns") == mtime_ns and prev.get("size") == size:
+        fp = prev["fp"]
+    elif FINGERPRINT_FN is _file_fingerprint_stat:
+        fp = _file_fingerprint_stat(real_p, (mtime_ns, size))
+    else:
+        fp = FINGERPRINT_FN(real_p)
+    return {"fp": fp, "mtime_ns": mtime_ns, "size": size, "chunks": chunks, "chunk_fps": list(chunk_fps or [])}
+
+
+def _fp_one(norm_p: str, real_p: str, prev: Optional[Dict[str, Any]], reuse: bool) -> Tuple[str, Dict[str, Any]]:
+    """reuse=False（fingerprint 方式換了）時舊 fp / chunk_fps 都不能沿用，chunks 數照舊保留"""
+    prev = prev or {}
+    chunks = int(prev.get("chunks", 0) or 0)
+    if not reuse:
+        return norm_p, _file_entry(real_p, chunks)
+    return norm_p, _file_entry(real_p, chunks, prev, prev.get("chunk_fps"))
+
+
+def _chunk_fp(ch: str, meta: Dict[str, Any]) -> str:
+    # chunk 內容 + 會寫進 metadata 的欄位（標題改了也要重寫）
+    raw = f"{meta['file']}\t{meta['title']}\t{meta['doc_type']}\t{meta['scope_call']}\n{ch}"
+    return _fp_hash(raw.encode("utf-8", errors="ignore")).hexdigest()
+
+
+def _chunk_diff(norm_p: str, old_fps: List[str], new_fps: List[str]) -> Tuple[List[str], List[int]]:
+    """
+    同一位置 chunk fp 相同就沿用 collection 裡那筆（id 由位置決定）
+    回傳 (要刪的舊 chunk ids, 要 upsert 的 chunk index)
+    - 位置還在的 chunk 用同一個 id upsert 覆寫，只有新檔比舊檔短時多出來的尾巴要 delete
+    """
+    kept = {i for i in range(min(len(old_fps), len(new_fps))) if old_fps[i] == new_fps[i]}
+    prefix = _chunk_id_prefix(norm_p)
+    stale = [f"{prefix}{i}" for i in range(len(new_fps), len(old_fps))]
+    return stale, [i for i in range(len(new_fps)) if i not in kept]
 
 
 # -----------------------------
 # Helpers: doc type / title
 # -----------------------------
 RE_MD_TITLE = re.compile(r"^\s*#{1,6}\s+(.+?)\s*$", re.MULTILINE)
+RE_DOC_EXT = re.compile(r"\.(md|txt)$", re.IGNORECASE)
+TITLE_SEARCH_CHARS = 4000  # 標題只在檔案開頭這段找
 
 
 def _guess_doc_type(norm_path: str, system_docs_dir: str, product_structured_dir: str, company_info_path: str) -> str:
@@ -127,11 +266,11 @@ def _guess_doc_type(norm_path: str, system_docs_dir: str, product_structured_dir
     return "extra"
 
 
-def _guess_title(base_name: str, doc_type: str, text_head: str) -> str:
+def _guess_title(base_name: str, doc_type: str, text: str) -> str:
     """
     - product: product_XXX.md -> XXX
     - company: company_info
-    - system/extra: 第一個 markdown 標題，沒有就用檔名去副檔名
+    - system/extra: 前 TITLE_SEARCH_CHARS 字內第一個 markdown 標題，沒有就用檔名去副檔名
     """
     base = (base_name or "").strip()
     if doc_type == "company":
@@ -140,17 +279,189 @@ def _guess_title(base_name: str, doc_type: str, text_head: str) -> str:
     if doc_type == "product" and base.startswith("product_") and base.lower().endswith(".md"):
         return base[len("product_") : -len(".md")].strip()
 
-    m = RE_MD_TITLE.search(text_head or "")
+    # endpos 限定範圍，效果等同 search(text[:N])，但不必先切出一段字串
+    m = RE_MD_TITLE.search(text or "", 0, TITLE_SEARCH_CHARS)
     if m:
         t = (m.group(1) or "").strip()
         if t:
             return t
 
     # fallback: filename without ext
-    t = re.sub(r"\.(md|txt)$", "", base, flags=re.IGNORECASE).strip()
+    t = RE_DOC_EXT.sub("", base).strip()
     return t or base
 
 
+def _prepare_file(
+    real_p: str,
+    norm_p: str,
+    chunk_size: int,
+    overlap: int,
+    system_docs_dir: str,
+    product_structured_dir: str,
+    company_info_path: str,
+    scope: str,
+) -> Tuple[str, List[str], List[str], List[Dict[str, Any]], str, List[str]]:
+    """
+    讀檔 + 切 chunk + 組 ids/docs/metas（放 module level 才能丟給 ProcessPool）
+    回傳 (norm_p, ids, docs, metas, doc_type, chunk_fps)；沒有 chunk 時 ids 為空
+    """
+    text = read_text(real_p)
+    chunks = chunk_text(text, chunk_size=chunk_size, overlap=overlap)
+    if not chunks:
+        return norm_p, [], [], [], "", []
+
+    base = os.path.basename(real_p)
+    doc_type = _guess_doc_type(norm_p, system_docs_dir, product_structured_dir, company_info_path)
+    title = _guess_title(base, doc_type, text)
+
+    ids: List[str] = []
+    docs: List[str] = []
+    metas: List[Dict[str, Any]] = []
+
+    id_prefix = _chunk_id_prefix(norm_p)
+    for idx, ch in enumerate(chunks):
+        doc_id = f"{id_prefix}{idx}"
+        ids.append(doc_id)
+        docs.append(ch)
+        metas.append(
+            {
+                "source": norm_p,            # ✅ stable key
+                "file": base,
+                "title": title,              # ✅ now for system docs too
+                "chunk": idx,
+                "doc_type": doc_type,        # ✅ product/system/company/extra
+                "scope_call": scope,         # ✅ keep caller scope for debug
+                "relpath": norm_p,           # ✅ alias for debugging
+            }
+        )
+    chunk_fps = [_chunk_fp(ch, meta) for ch, meta in zip(docs, metas)]
+    return norm_p, ids, docs, metas, doc_type, chunk_fps
+
+
+def _prepare_file_safe(args: Tuple) -> Tuple[Optional[Tuple], str]:
+    # 例外留在 worker 裡轉成字串，單一檔案失敗不會中斷整個 map
+    try:
+        return _prepare_file(*args), ""
+    except Exception as e:
+        return None, str(e)
+
+
+# 讀檔 + 切 chunk 分給多個 process（>1 才開）。預設 1：結果要整批 pickle 回主程序，實測比單 process 慢，
+# 真正的成本在 embedding，已由 _CollectionWriter 的背景 thread 重疊；spawn 下每個 worker 還得重新 import chromadb
+PREP_WORKERS = max(1, int(os.getenv("VDB_PREP_WORKERS", "1")))
+
+
+def _iter_prepared(jobs: List[Tuple], workers: int = PREP_WORKERS):
+    """依 jobs 順序產出 (_prepare_file 結果 or None, error)；主程序邊收邊寫 Chroma"""
+    if workers > 1 and len(jobs) >= 2 * workers:
+        chunksize = max(1, min(16, len(jobs) // (workers * 4)))
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            yield from ex.map(_prepare_file_safe, jobs, chunksize=chunksize)
+    else:
+        for job in jobs:
+            yield _prepare_file_safe(job)
+
+
+def _add_batch_size() -> int:
+    """
+    CHROMA_ADD_BATCH：每次 collection.add 最多幾個 chunk（預設 512，可設 1~4096）
+    Chroma 建議單次 add 約 250 筆以上吞吐量就持平；一般檔案 chunk 數都在 512 內，一個檔案一次 add、一個交易
+    """
+    batch = int(os.getenv("CHROMA_ADD_BATCH", "512"))
+    return max(1, min(batch, 4096))
+
+
+# 跨檔案累積到這麼多個 chunk 才呼叫一次 embedding（小檔案不必各自跑一個沒塞滿的 batch）
+EMBED_BATCH = max(1, int(os.getenv("EMBED_BATCH", "256")))
+# manifest 預設寫成緊湊 JSON；要人工查看時設 VDB_MANIFEST_PRETTY=1
+MANIFEST_PRETTY = bool(os.getenv("VDB_MANIFEST_PRETTY"))
+
+
+class _CollectionWriter:
+    """
+    背景 thread 依序執行 collection.delete / add / upsert：主程序準備下一個檔案時，前一批同時寫進 Chroma
+    - 所有寫入都經過同一條 queue，同一個 source 的 delete 一定先於 add
+    - 有 embed_fn 時，add / upsert 先累積到 embed_batch 個 chunk，一次算完 embedding 再帶 embeddings= 寫入
+    - 某個 source 的 add 失敗後，該 source 後面的批次略過，錯誤記在 errors[source]
+    """
+
+    def __init__(self, collection, embed_fn=None, embed_batch: int = EMBED_BATCH, maxsize: int = 4):
+        self.collection = collection
+        self.embed_fn = embed_fn
+        self.embed_batch = embed_batch
+        self.errors: Dict[str, str] = {}
+        self._pending: List[Tuple[str, str, Dict[str, Any]]] = []
+        self._pending_docs = 0
+        self._q: "queue.Queue[Optional[Tuple[str, str, Dict[str, Any]]]]" = queue.Queue(maxsize=maxsize)
+        self._t = threading.Thread(target=self._run, daemon=True)
+        self._t.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._q.get()
+            if item is None:
+                self._flush()
+                return
+            source, op, kwargs = item
+            if op == "delete":
+                # 每輪每個 source 只出現一次，pending 裡不會有它的 add，不必先 flush
+                try:
+                    self.collection.delete(**kwargs)
+                except Exception:
+                    pass
+                continue
+            if source in self.errors:
+                continue
+            if self.embed_fn is None:
+                self._add(source, op, kwargs)
+                continue
+            self._pending.append((source, op, kwargs))
+            self._pending_docs += len(kwargs["documents"])
+            if self._pending_docs >= self.embed_batch:
+                self._flush()
+
+    def _flush(self) -> None:
+        pending, self._pending, self._pending_docs = self._pending, [], 0
+        if not pending:
+            return
+        docs = [d for _, _, kw in pending for d in kw["documents"]]
+        try:
+            embs = self.embed_fn(docs)
+        except Exception as e:
+            for source, _, _ in pending:
+                self.errors.setdefault(source, str(e))
+            return
+        pos = 0
+        for source, op, kw in pending:
+            n = len(kw["documents"])
+            if source not in self.errors:
+                self._add(source, op, dict(kw, embeddings=embs[pos : pos + n]))
+            pos += n
+
+    def _add(self, source: str, op: str, kwargs: Dict[str, Any]) -> None:
+        try:
+            getattr(self.collection, op)(**kwargs)
+        except Exception as e:
+            self.errors[source] = str(e)
+
+    def delete_source(self, source: str) -> None:
+        self._q.put((source, "delete", {"where": {"source": source}}))
+
+    def delete_ids(self, source: str, ids: List[str]) -> None:
+        self._q.put((source, "delete", {"ids": ids}))
+
+    def add(
+        self, source: str, ids: List[str], docs: List[str], metas: List[Dict[str, Any]], upsert: bool = False
+    ) -> None:
+        """upsert=True：同 id 的舊 chunk 直接覆寫，不必先 delete"""
+        op = "upsert" if upsert else "add"
+        self._q.put((source, op, {"ids": ids, "documents": docs, "metadatas": metas}))
+
+    def close(self) -> None:
+        self._q.put(None)
+        self._t.join()
+
+
 # -----------------------------
 # Vector DB
 # -----------------------------
@@ -176,7 +487,8 @@ class VectorDatabase:
         self.client = chromadb.PersistentClient(path=self.persist_dir)
 
         self.embedding_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name=os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2")
+            model_name=os.getenv("EMBED_MODEL", "all-MiniLM-L6-v2"),
+            device=os.getenv("EMBED_DEVICE", "cpu"),  # e.g. cuda / mps
         )
 
         self.collection = self.client.get_or_create_collection(
@@ -196,6 +508,9 @@ class VectorDatabase:
         self._dirty = True  # 初始視為 dirty（尚未 build）
         self._last_error = ""
 
+        # _collect_sources 的結果：scope -> ((roots, extra_files), 目錄 mtime 清單, sources)
+        self._sources_cache: Dict[str, Tuple[Tuple, List[Tuple[str, int]], List[Tuple[str, str]]]] = {}
+
         # 允許自訂額外掃描路徑（預設不掃整個 data，避免雜訊）
         # e.g. VDB_EXTRA_ROOTS="data/extra_docs;data/policies"
         self._extra_roots = [p.strip() for p in (os.getenv("VDB_EXTRA_ROOTS", "") or "").split(";") if p.strip()]
@@ -296,30 +611,34 @@ class VectorDatabase:
         - 讀檔用 real_path（Windows 路徑更穩）
         """
         roots, extra_files = self._source_roots(scope=scope)
+        cache_key = (tuple(roots), tuple(extra_files))
 
-        files: List[str] = []
-        for r in roots:
-            if not r or (not os.path.isdir(r)):
-                continue
-            files += glob.glob(os.path.join(r, "**/*.md"), recursive=True)
-            files += glob.glob(os.path.join(r, "**/*.txt"), recursive=True)
+        # 所有走過的目錄 mtime 都沒變 -> 檔案清單不會變，只需每個目錄 stat 一次
+        with self._lock:
+            cached = self._sources_cache.get(scope)
+        if cached and cached[0] == cache_key and _dirs_unchanged(cached[1]):
+            return list(cached[2])
 
-        files += extra_files
+        # 每個 root 本身已依路徑排序產出，merge 起來就是整體排序，不必最後再 sort 一次
+        dir_stamps: List[Tuple[str, int]] = []
+        streams = [_iter_docs(r, dir_stamps) for r in roots if r and os.path.isdir(r)]
+        # 走訪出來的已由 DirEntry 確認是檔案；只有 extra_files 需要另外 isfile
+        streams.append(sorted((p for p in extra_files if p and os.path.isfile(os.path.normpath(p))), key=_norm_path))
 
         uniq: List[Tuple[str, str]] = []
         seen = set()
-        for p in files:
+        for p in heapq.merge(*streams, key=_norm_path):
             if not p:
                 continue
             rp = os.path.normpath(p)
             if rp in seen:
                 continue
-            if os.path.isfile(rp):
-                seen.add(rp)
-                uniq.append((rp, _norm_path(rp)))
+            seen.add(rp)
+            uniq.append((rp, _norm_path(rp)))
 
-        uniq.sort(key=lambda x: x[1])
-        return uniq
+        with self._lock:
+            self._sources_cache[scope] = (cache_key, dir_stamps, uniq)
+        return list(uniq)
 
     def list_sources(self, scope: str = "all") -> List[Dict[str, Any]]:
         sources = self._collect_sources(scope=scope)
@@ -344,6 +663,9 @@ class VectorDatabase:
         if not os.path.isfile(p):
             return {}
         try:
+            if orjson is not None:
+                with open(p, "rb") as f:
+                    return orjson.loads(f.read()) or {}
             with open(p, "r", encoding="utf-8") as f:
                 return json.load(f) or {}
         except Exception:
@@ -351,23 +673,87 @@ class VectorDatabase:
 
     def _write_manifest(self, data: Dict[str, Any], scope: str = "all") -> None:
         p = self.manifest_path(scope=scope)
+        tmp = p + ".tmp"
         try:
-            with open(p, "w", encoding="utf-8") as f:
-                json.dump(data or {}, f, ensure_ascii=False, indent=2)
+            # 先寫暫存檔再 os.replace：中途當掉也不會留下寫一半的 manifest
+            if orjson is not None:
+                raw = orjson.dumps(data or {}, option=orjson.OPT_INDENT_2 if MANIFEST_PRETTY else 0)
+            elif MANIFEST_PRETTY:
+                raw = json.dumps(data or {}, ensure_ascii=False, indent=2).encode("utf-8")
+            else:
+                raw = json.dumps(data or {}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            with open(tmp, "wb") as f:
+                f.write(raw)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, p)
         except Exception as e:
             logger.warning(f"write manifest failed: {e}")
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
     def get_manifest_fingerprint(self, scope: str = "all") -> str:
         m = self._read_manifest(scope=scope)
         return (m.get("fingerprint") or "").strip()
 
-    def _build_global_fingerprint(self, per_file: Dict[str, Any]) -> str:
-        items = []
-        for k in sorted(per_file.keys()):
-            v = per_file.get(k) or {}
-            items.append(f"{k}\t{v.get('fp','')}\t{v.get('chunks',0)}")
-        raw = "\n".join(items).encode("utf-8", errors="ignore")
-        return hashlib.sha256(raw).hexdigest()
+    @staticmethod
+    def _manifest_up_to_date(old: Dict[str, Any], sources: List[Tuple[str, str]]) -> bool:
+        """
+        只 stat、不算 hash 的快速檢查：
+        - fingerprint 方式相同、來源檔案集合與 manifest 相同
+        - 每個檔案的 (mtime_ns, size) 都等於 manifest 記錄的值（此時 ensure_fresh 也只會沿用舊 fp）
+        """
+        old_files: Dict[str, Any] = old.get("files") or {}
+        if not old.get("fingerprint") or old.get("fingerprint_mode") != FINGERPRINT_MODE_LABEL:
+            return False
+        if len(old_files) != len(sources):
+            return False
+        for real_p, norm_p in sources:
+            prev = old_files.get(norm_p)
+            if not prev or not prev.get("fp") or not prev.get("mtime_ns"):
+                return False
+            if _stat_tuple(real_p) != (prev.get("mtime_ns"), prev.get("size")):
+                return False
+        return True
+
+    def _build_global_fingerprint(
+        self, per_file: Dict[str, Any], old: Optional[Dict[str, Any]] = None
+    ) -> Tuple[str, str]:
+        """
+        整體 fingerprint = hash(所有檔案 leaf 的 XOR + 檔案數)，回傳 (fingerprint, XOR 累加值)
+        - leaf = hash(path, fp, chunks)，寫進各檔的 leaf_fp；XOR 與順序無關，不必排序
+        - old 是同一 fingerprint 方式的舊 manifest 時，從舊累加值出發，只對 leaf 有變的檔案 XOR 出 / XOR 進
+        """
+        old = old or {}
+        same_mode = old.get("fingerprint_mode") == FINGERPRINT_MODE_LABEL
+        old_files: Dict[str, Any] = (old.get("files") or {}) if same_mode else {}
+        old_acc = old.get("fingerprint_acc") if same_mode else ""
+        incremental = bool(old_acc) and all(v.get("leaf_fp") for v in old_files.values())
+
+        acc = int(old_acc, 16) if incremental else 0
+        if incremental:
+            for norm_p, prev in old_files.items():
+                if norm_p not in per_file:
+                    acc ^= int(prev["leaf_fp"], 16)
+
+        for norm_p, info in per_file.items():
+            prev = old_files.get(norm_p) or {}
+            leaf = prev.get("leaf_fp")
+            if not (leaf and prev.get("fp") == info.get("fp") and prev.get("chunks") == info.get("chunks")):
+                raw = f"{norm_p}\t{info.get('fp','')}\t{info.get('chunks',0)}".encode("utf-8", errors="ignore")
+                new_leaf = _fp_hash(raw).hexdigest()
+                if incremental:
+                    acc ^= int(new_leaf, 16) ^ (int(leaf, 16) if leaf else 0)
+                leaf = new_leaf
+            if not incremental:
+                acc ^= int(leaf, 16)
+            info["leaf_fp"] = leaf
+
+        acc_hex = format(acc, "x")
+        global_fp = _fp_hash(f"{acc_hex}\t{len(per_file)}".encode("utf-8")).hexdigest()
+        return global_fp, acc_hex
 
     # -----------------------------
     # Incremental ensure (scoped)
@@ -398,11 +784,44 @@ class VectorDatabase:
                 old = self._read_manifest(scope=scope)
                 old_files: Dict[str, Any] = old.get("files") or {}
 
+                # 來源清單與每個檔案的 mtime/size 都跟 manifest 一致 -> 不會有任何變動，連 manifest 都不必重寫
+                if self._manifest_up_to_date(old, sources):
+                    self.mark_dirty(False)
+                    return {
+                        "ok": True,
+                        "action": "noop",
+                        "scope": scope,
+                        "elapsed_ms": int((time.time() - t0) * 1000),
+                        "fingerprint": old.get("fingerprint"),
+                        "stats": {
+                            "sources_total": len(sources),
+                            "unchanged_files": len(sources),
+                            "changed_files": 0,
+                            "removed_files": 0,
+                            "added_chunks": 0,
+                            "reused_chunks": 0,
+                            "deleted_removed_files": 0,
+                            "skipped_files": 0,
+                            "doc_type_files_touched": {"product": 0, "system": 0, "company": 0, "extra": 0},
+                            "chunk_size": self.chunk_size,
+                            "chunk_overlap": self.chunk_overlap,
+                        },
+                    }
+
                 # compute new per-file fp
-                new_files: Dict[str, Any] = {}
-                for norm_p in sources_norm:
-                    real_p = norm_to_real.get(norm_p, norm_p)
-                    new_files[norm_p] = {"fp": FINGERPRINT_FN(real_p), "chunks": int(old_files.get(norm_p, {}).get("chunks", 0) or 0)}
+                # fingerprint 方式（模式 / hash）沒變才能沿用舊 fp，否則全部重算
+                reuse_fp = old.get("fingerprint_mode") == FINGERPRINT_MODE_LABEL
+                fp_args = [
+                    (norm_p, norm_to_real.get(norm_p, norm_p), old_files.get(norm_p), reuse_fp)
+                    for norm_p in sources_norm
+                ]
+                new_files: Dict[str, Any]
+                if FP_WORKERS > 1 and len(fp_args) > 1:
+                    # map 保持 sources 順序，manifest 與 changed 的順序跟逐檔計算時一樣
+                    with ThreadPoolExecutor(max_workers=min(FP_WORKERS, len(fp_args))) as ex:
+                        new_files = dict(ex.map(lambda a: _fp_one(*a), fp_args))
+                else:
+                    new_files = dict(_fp_one(*a) for a in fp_args)
 
                 removed = [p for p in old_files.keys() if p not in new_files]
                 changed: List[str] = []
@@ -426,75 +845,92 @@ class VectorDatabase:
                     except Exception:
                         pass
 
-                batch = int(os.getenv("CHROMA_ADD_BATCH", "256"))
-                batch = max(64, min(batch, 1024))
+                batch = _add_batch_size()
 
-                for norm_p in changed:
-                    real_p = norm_to_real.get(norm_p, norm_p)
-                    try:
-                        # delete old chunks for this source
+                jobs = [
+                    (norm_to_real.get(norm_p, norm_p), norm_p, self.chunk_size, self.chunk_overlap,
+                     system_docs_dir, product_structured_dir, company_info_path, scope)
+                    for norm_p in changed
+                ]
+                reused_chunks = 0
+                writer = _CollectionWriter(self.collection, self.embedding_fn)
+                written: Dict[str, Tuple[int, int]] = {}  # norm_p -> (送出的 chunks, 原本 manifest 的 chunks)
+                try:
+                    for norm_p, (prepared, err) in zip(changed, _iter_prepared(jobs)):
+                        info = new_files[norm_p]
+                        deleted = False
                         try:
-                            self.collection.delete(where={"source": norm_p})
-                        except Exception:
-                            pass
-
-                        text = read_text(real_p)
-                        chunks = chunk_text(text, chunk_size=self.chunk_size, overlap=self.chunk_overlap)
-                        if not chunks:
+                            old_fps = info["chunk_fps"]
+                            # 舊 chunk fp 齊全時只 upsert 有變的 chunk、刪掉多出來的尾巴；否則整個 source 刪掉重灌
+                            diff = prepared is not None and bool(old_fps) and len(old_fps) == info["chunks"]
+                            if not diff:
+                                # delete old chunks for this source
+                                writer.delete_source(norm_p)
+                                deleted = True
+
+                            if prepared is None:
+                                raise RuntimeError(err)
+
+                            _, ids, docs, metas, doc_type, chunk_fps = prepared
+                            if diff:
+                                stale, add_idx = _chunk_diff(norm_p, old_fps, chunk_fps)
+                                if stale:
+                                    writer.delete_ids(norm_p, stale)
+                            else:
+                                add_idx = list(range(len(ids)))
+
+                            if not ids:
+                                skipped_files += 1
+                                info["chunks"] = 0
+                                info["chunk_fps"] = []
+                                continue
+
+                            doc_type_counter[doc_type] = doc_type_counter.get(doc_type, 0) + 1
+
+                            if len(add_idx) < len(ids):
+                                ids = [ids[i] for i in add_idx]
+                                docs = [docs[i] for i in add_idx]
+                                metas = [metas[i] for i in add_idx]
+                            for i in range(0, len(ids), batch):
+                                writer.add(
+                                    norm_p, ids[i : i + batch], docs[i : i + batch], metas[i : i + batch], upsert=diff
+                                )
+
+                            written[norm_p] = (len(ids), info["chunks"])
+                            reused_chunks += len(chunk_fps) - len(ids)
+                            info["chunks"] = len(chunk_fps)
+                            info["chunk_fps"] = chunk_fps
+                            added_chunks += len(ids)
+
+                        except Exception as e:
                             skipped_files += 1
-                            new_files[norm_p]["chunks"] = 0
-                            continue
-
-                        base = os.path.basename(real_p)
-                        head = text[:4000] if text else ""
-                        doc_type = _guess_doc_type(norm_p, system_docs_dir, product_structured_dir, company_info_path)
-                        title = _guess_title(base, doc_type, head)
-
-                        doc_type_counter[doc_type] = doc_type_counter.get(doc_type, 0) + 1
-
-                        ids: List[str] = []
-                        docs: List[str] = []
-                        metas: List[Dict[str, Any]] = []
-
-                        for idx, ch in enumerate(chunks):
-                            doc_id = _safe_id(f"{norm_p}::chunk{idx}")
-                            ids.append(doc_id)
-                            docs.append(ch)
-                            metas.append(
-                                {
-                                    "source": norm_p,            # ✅ stable key
-                                    "file": base,
-                                    "title": title,              # ✅ now for system docs too
-                                    "chunk": idx,
-                                    "doc_type": doc_type,        # ✅ product/system/company/extra
-                                    "scope_call": scope,         # ✅ keep caller scope for debug
-                                    "relpath": norm_p,           # ✅ alias for debugging
-                                }
-                            )
-
-                        for i in range(0, len(ids), batch):
-                            self.collection.add(
-                                ids=ids[i : i + batch],
-                                documents=docs[i : i + batch],
-                                metadatas=metas[i : i + batch],
-                            )
-
-                        new_files[norm_p]["chunks"] = len(chunks)
-                        added_chunks += len(chunks)
-
-                    except Exception as e:
-                        skipped_files += 1
-                        logger.warning(f"ensure_fresh skip {norm_p}: {e}")
-
-                global_fp = self._build_global_fingerprint(new_files)
+                            logger.warning(f"ensure_fresh skip {norm_p}: {e}")
+                            # collection 裡這個 source 的狀態已不可信：chunk_fps 清掉，下次改動時整檔重灌
+                            info["chunk_fps"] = []
+                            if deleted:
+                                info["chunks"] = 0
+                finally:
+                    writer.close()
+
+                # add 失敗的檔案：跟同步寫入時一樣算 skip，chunks 維持原值；collection 狀態不明，chunk_fps 清掉下次整檔重灌
+                for norm_p, err in writer.errors.items():
+                    n, old_chunks = written[norm_p]
+                    new_files[norm_p]["chunks"] = old_chunks
+                    new_files[norm_p]["chunk_fps"] = []
+                    added_chunks -= n
+                    skipped_files += 1
+                    logger.warning(f"ensure_fresh skip {norm_p}: {err}")
+
+                global_fp, fp_acc = self._build_global_fingerprint(new_files, old)
 
                 manifest = {
                     "collection": self.collection_name,
                     "scope": scope,
                     "fingerprint": global_fp,
+                    "fingerprint_acc": fp_acc,
                     "rebuilt_at": int(time.time()),
                     "mode": "incremental",
-                    "fingerprint_mode": os.getenv("VDB_FINGERPRINT_MODE", "stat"),
+                    "fingerprint_mode": FINGERPRINT_MODE_LABEL,
                     "files": new_files,
                     "stats": {
                         "sources_total": len(sources_norm),
@@ -502,6 +938,7 @@ class VectorDatabase:
                         "changed_files": len(changed),
                         "removed_files": len(removed),
                         "added_chunks": added_chunks,
+                        "reused_chunks": reused_chunks,
                         "deleted_removed_files": len(removed),
                         "skipped_files": skipped_files,
                         "doc_type_files_touched": doc_type_counter,
@@ -566,69 +1003,61 @@ class VectorDatabase:
                 per_file: Dict[str, Any] = {}
                 doc_type_counter = {"product": 0, "system": 0, "company": 0, "extra": 0}
 
-                batch = int(os.getenv("CHROMA_ADD_BATCH", "256"))
-                batch = max(64, min(batch, 1024))
+                batch = _add_batch_size()
 
-                for real_p, norm_p in sources:
-                    try:
-                        text = read_text(real_p)
-                        chunks = chunk_text(text, chunk_size=self.chunk_size, overlap=self.chunk_overlap)
-                        if not chunks:
+                jobs = [
+                    (real_p, norm_p, self.chunk_size, self.chunk_overlap,
+                     system_docs_dir, product_structured_dir, company_info_path, scope)
+                    for real_p, norm_p in sources
+                ]
+                writer = _CollectionWriter(self.collection, self.embedding_fn)
+                written: Dict[str, Tuple[str, int]] = {}  # norm_p -> (real_p, 送出的 chunks)
+                try:
+                    for (real_p, norm_p), (prepared, err) in zip(sources, _iter_prepared(jobs)):
+                        try:
+                            if prepared is None:
+                                raise RuntimeError(err)
+
+                            _, ids, docs, metas, doc_type, chunk_fps = prepared
+                            if not ids:
+                                skipped += 1
+                                per_file[norm_p] = _file_entry(real_p, 0)
+                                continue
+
+                            doc_type_counter[doc_type] = doc_type_counter.get(doc_type, 0) + 1
+
+                            for i in range(0, len(ids), batch):
+                                writer.add(norm_p, ids[i : i + batch], docs[i : i + batch], metas[i : i + batch])
+
+                            written[norm_p] = (real_p, len(ids))
+                            total_docs += len(ids)
+                            per_file[norm_p] = _file_entry(real_p, len(ids), chunk_fps=chunk_fps)
+
+                        except Exception as e:
                             skipped += 1
-                            per_file[norm_p] = {"fp": FINGERPRINT_FN(real_p), "chunks": 0}
-                            continue
-
-                        base = os.path.basename(real_p)
-                        head = text[:4000] if text else ""
-                        doc_type = _guess_doc_type(norm_p, system_docs_dir, product_structured_dir, company_info_path)
-                        title = _guess_title(base, doc_type, head)
-
-                        doc_type_counter[doc_type] = doc_type_counter.get(doc_type, 0) + 1
-
-                        ids: List[str] = []
-                        docs: List[str] = []
-                        metas: List[Dict[str, Any]] = []
-
-                        for idx, ch in enumerate(chunks):
-                            doc_id = _safe_id(f"{norm_p}::chunk{idx}")
-                            ids.append(doc_id)
-                            docs.append(ch)
-                            metas.append(
-                                {
-                                    "source": norm_p,
-                                    "file": base,
-                                    "title": title,
-                                    "chunk": idx,
-                                    "doc_type": doc_type,
-                                    "scope_call": scope,
-                                    "relpath": norm_p,
-                                }
-                            )
-
-                        for i in range(0, len(ids), batch):
-                            self.collection.add(
-                                ids=ids[i : i + batch],
-                                documents=docs[i : i + batch],
-                                metadatas=metas[i : i + batch],
-                            )
-
-                        total_docs += len(chunks)
-                        per_file[norm_p] = {"fp": FINGERPRINT_FN(real_p), "chunks": len(chunks)}
-
-                    except Exception as e:
-                        skipped += 1
-                        logger.warning(f"rebuild_full skip {norm_p}: {e}")
-                        per_file[norm_p] = {"fp": FINGERPRINT_FN(real_p), "chunks": 0}
-
-                global_fp = self._build_global_fingerprint(per_file)
+                            logger.warning(f"rebuild_full skip {norm_p}: {e}")
+                            per_file[norm_p] = _file_entry(real_p, 0)
+                finally:
+                    writer.close()
+
+                # add 失敗的檔案：跟同步寫入時一樣算 skip、chunks 記 0
+                for norm_p, err in writer.errors.items():
+                    real_p, n = written[norm_p]
+                    total_docs -= n
+                    skipped += 1
+                    logger.warning(f"rebuild_full skip {norm_p}: {err}")
+                    per_file[norm_p] = _file_entry(real_p, 0)
+
+                global_fp, fp_acc = self._build_global_fingerprint(per_file)
 
                 manifest = {
                     "collection": self.collection_name,
                     "scope": scope,
                     "fingerprint": global_fp,
+                    "fingerprint_acc": fp_acc,
                     "rebuilt_at": int(time.time()),
                     "mode": "full",
-                    "fingerprint_mode": os.getenv("VDB_FINGERPRINT_MODE", "stat"),
+                    "fingerprint_mode": FINGERPRINT_MODE_LABEL,
                     "files": per_file,
                     "stats": {
                         "documents_loaded": total_docs,